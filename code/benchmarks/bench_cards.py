@@ -0,0 +1,110 @@
+"""
+Compare building the networks card by string concatenation + json.loads
+(the original approach) with the precompiled CardTemplate.
+
+    python benchmarks/bench_cards.py [--sizes 10,100,1000,5000]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import cards  # noqa: E402
+
+ATTACHMENT_START = '''
+{
+    "contentType": "application/vnd.microsoft.card.adaptive",
+    "content": {
+        "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
+        "type": "AdaptiveCard",
+        "version": "1.0",
+        "body": [
+            {
+                "type": "ColumnSet",
+                "columns": [
+                    {
+                        "type": "Column",
+                        "width": 2,
+                        "items": [
+                            {
+                                "type": "TextBlock",
+                                "text": "Choose a Network",
+                                "weight": "Bolder",
+                                "size": "Medium"
+                            },
+                            {
+                                "type": "Input.Text",
+                                "placeholder": "Placeholder text",
+                                "isVisible": false,
+                                "id": "card_type",
+                                "value": "meraki_choose_network"
+                            },
+                            {
+                                "type": "TextBlock",
+                                "size": "Small",
+                                "text": "Network"
+                            },
+                            {
+                                "type": "Input.ChoiceSet",
+                                "id": "network_id",
+                                "placeholder": "Choose an organization network...",
+                                "choices": [
+'''
+ATTACHMENT_END = '''
+                                ]
+                            }
+                        ]
+                    }
+                ]
+            }
+        ],
+        "actions": [
+            {
+                "type": "Action.Submit",
+                "title": "Submit"
+            }
+        ]
+    }
+}
+'''
+
+
+def build_legacy(networks):
+    # String building as bot.py used to do it, then the json.dumps that
+    # requests performs on the parsed card
+    attachment_insert = ''''''
+    for network in networks:
+        attachment_insert += '''
+        {
+            "title": "''' + str(network[0]) + '''",
+            "value": "''' + str(network[1]) + '''"
+        },
+        '''
+    attachment = ATTACHMENT_START + attachment_insert.rsplit(',', 1)[0] + ATTACHMENT_END
+    return json.dumps(json.loads(attachment))
+
+
+def build_template(networks):
+    return cards.NETWORKS_CARD.dumps(choices=cards.choices(networks), windows=cards.window_choices())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="10,100,1000,5000")
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    print("{:>7} {:>14} {:>14} {:>8}".format("choices", "legacy (us)", "template (us)", "speedup"))
+    for size in [int(s) for s in args.sizes.split(",")]:
+        networks = [("Branch {}".format(i), "N_{}".format(600000000000 + i)) for i in range(size)]
+        number = max(1, args.number * 10 // size)
+        legacy = min(timeit.repeat(lambda: build_legacy(networks), number=number, repeat=3)) / number
+        template = min(timeit.repeat(lambda: build_template(networks), number=number, repeat=3)) / number
+        print("{:>7} {:>14.1f} {:>14.1f} {:>7.1f}x".format(size, legacy * 1e6, template * 1e6, legacy / template))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Measure bot cold start: time to import bot.py and time until create_app()
+returns a bot ready to serve (webhook registration and background tasks
+skipped), each in a fresh interpreter. For comparison, also time importing
+the heavy libraries that used to be loaded eagerly at import.
+
+    python benchmarks/bench_startup.py [--runs 5] [--warm]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+STARTUP = """
+import json, sys, time
+start = time.perf_counter()
+import bot
+imported = time.perf_counter()
+app = bot.create_app(webhooks=False, warm={warm}, background=False)
+app.test_client().get("/health")
+ready = time.perf_counter()
+print(json.dumps({{"import": imported - start, "ready": ready - start}}))
+"""
+
+EAGER = """
+import json, time
+start = time.perf_counter()
+import numpy, meraki
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+print(json.dumps({"import": time.perf_counter() - start}))
+"""
+
+
+def run(script, env, cwd):
+    out = subprocess.check_output([sys.executable, "-c", script], env=env, cwd=cwd)
+    return json.loads(out.decode("utf-8").strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--warm", action="store_true", help="Include warm_up() in ready time")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ)
+        env["PYTHONPATH"] = CODE_DIR
+        # Placeholder credentials; nothing here talks to Webex
+        env.setdefault("COB_BOT_APP_NAME", "bench")
+        env.setdefault("COB_BOT_EMAIL", "bench@webex.bot")
+        env.setdefault("COB_BOT_TOKEN", "bench")
+        env["MEDIA_PATH"] = tmp
+
+        startup = [run(STARTUP.format(warm=args.warm), env, tmp) for _ in range(args.runs)]
+        eager = [run(EAGER, env, tmp) for _ in range(args.runs)]
+
+    print("{:<36} {:>10}".format("median over {} runs".format(args.runs), "seconds"))
+    print("{:<36} {:>10.3f}".format("import bot", statistics.median(r["import"] for r in startup)))
+    print("{:<36} {:>10.3f}".format("ready to serve", statistics.median(r["ready"] for r in startup)))
+    print("{:<36} {:>10.3f}".format("numpy + matplotlib + meraki import", statistics.median(r["import"] for r in eager)))
+
+
+if __name__ == "__main__":
+    main()
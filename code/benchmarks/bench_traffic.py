@@ -0,0 +1,76 @@
+"""
+Compare the legacy traffic aggregation loop with the NumPy/top-K path on
+synthetic getNetworkTraffic responses.
+
+    python benchmarks/bench_traffic.py [--sizes 10000,100000,1000000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from traffic import aggregate_traffic, aggregate_traffic_legacy  # noqa: E402
+
+APPLICATIONS = ["Miscellaneous web", "Miscellaneous secure web", "Webex",
+                "Office 365", "DNS", "Non-web TCP", "UDP"]
+
+
+def generate_traffic(size, unique_destinations, seed=0):
+    rng = random.Random(seed)
+    destinations = []
+    for i in range(unique_destinations):
+        if i % 4 == 0:
+            destinations.append("10.{}.{}.{}".format(i // 65536 % 256, i // 256 % 256, i % 256))
+        else:
+            destinations.append("host{}.example{}.com".format(i, i % 97))
+    return [
+        {
+            "application": rng.choice(APPLICATIONS),
+            "destination": rng.choice(destinations),
+            "protocol": "TCP",
+            "port": 443,
+            "sent": rng.randint(1, 50000),
+            "recv": rng.randint(1, 500000),
+            "numClients": rng.randint(1, 20),
+            "activeTime": rng.randint(1, 3600),
+            "flows": rng.randint(1, 100)
+        }
+        for _ in range(size)
+    ]
+
+
+def best_of(repeat, fn, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--unique", type=int, default=20000,
+                        help="Distinct destinations in the generated data")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print("{:>9} {:>12} {:>12} {:>8}".format("entries", "legacy (s)", "numpy (s)", "speedup"))
+    for size in [int(s) for s in args.sizes.split(",")]:
+        network_traffic = generate_traffic(size, min(args.unique, size))
+        legacy_time, legacy = best_of(args.repeat, aggregate_traffic_legacy, network_traffic)
+        new_time, new = best_of(args.repeat, aggregate_traffic, network_traffic,
+                                ["Miscellaneous web", "Miscellaneous secure web"], args.top)
+        if [d for d, _ in legacy[:args.top]] != [d for d, _ in new]:
+            sys.stderr.write("Warning: top {} differs at size {}\n".format(args.top, size))
+        print("{:>9} {:>12.4f} {:>12.4f} {:>7.1f}x".format(size, legacy_time, new_time, legacy_time / new_time))
+
+
+if __name__ == "__main__":
+    main()
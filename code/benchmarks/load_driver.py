@@ -0,0 +1,263 @@
+"""
+Fire synthetic message and attachmentActions webhooks at the bot at a
+target rate and report webhook-to-reply latency (p50/p99) and throughput
+per card flow. Upstreams are served by stub_upstreams.py in this process,
+which sees every reply the bot posts.
+
+By default the bot is started as a subprocess pointed at the stubs:
+
+    python benchmarks/load_driver.py [--rate 5] [--duration 30] [--flows traffic,operations]
+
+To drive a bot you started yourself, run it with the printed *_API_URL
+variables and REGISTER_WEBHOOKS=false, then pass --bot-url.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_upstreams import StubUpstreams  # noqa: E402
+
+CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def is_reply(event, message):
+    return event == "post"
+
+
+def is_card(event, message):
+    return event == "post" and bool(message.get("attachments"))
+
+
+def is_text(prefix):
+    def done(event, message):
+        return event in ("post", "edit") and (message.get("markdown") or "").startswith(prefix)
+    return done
+
+
+# Flow name -> (webhook resource, what the user sends, reply that completes it)
+FLOWS = {
+    "operations": ("messages", lambda n, nets: "/operations", is_card),
+    "network_search": ("messages", lambda n, nets: "/network branch", is_reply),
+    "traffic": ("attachmentActions",
+                lambda n, nets: {"card_type": "meraki_choose_network", "network_id": random.choice(nets),
+                                 "window": "live"},
+                is_card),
+    "org_traffic": ("attachmentActions",
+                    lambda n, nets: {"card_type": "choose_operation", "operation": "meraki_org_traffic"},
+                    is_card),
+    "umbrella_add": ("attachmentActions",
+                     lambda n, nets: {"card_type": "umbrella_destination", "destination_list": "1",
+                                      "domain": "load{}.example.com".format(n)},
+                     is_text("Destination added")),
+    "umbrella_bulk": ("attachmentActions",
+                      lambda n, nets: {"card_type": "umbrella_bulk", "destination_list": "1",
+                                       "domains": "\n".join("bulk{}-{}.example.com".format(n, i) for i in range(200))},
+                      is_text("Added"))
+}
+
+
+class Request(object):
+    __slots__ = ("flow", "sent_at", "first_reply", "done_at", "status")
+
+    def __init__(self, flow):
+        self.flow = flow
+        self.sent_at = None
+        self.first_reply = None
+        self.done_at = None
+        self.status = None
+
+
+class LoadDriver(object):
+    """
+    Sends one webhook per request, each in its own room, and matches the
+    bot's replies to requests by room.
+    """
+
+    def __init__(self, bot_url, stubs, flows):
+        self.bot_url = bot_url.rstrip("/")
+        self.stubs = stubs
+        self.flows = flows
+        self.requests = {}
+        self._done = threading.Condition()
+        self._ids = itertools.count()
+        stubs.listener = self.on_reply
+
+    def on_reply(self, event, room_id, message):
+        req = self.requests.get(room_id)
+        if req is None:
+            return
+        now = time.monotonic()
+        with self._done:
+            if req.first_reply is None and event == "post":
+                req.first_reply = now
+            if req.done_at is None and FLOWS[req.flow][2](event, message):
+                req.done_at = now
+                self._done.notify_all()
+
+    def fire(self, flow):
+        n = next(self._ids)
+        room_id = "load-room-{}".format(n)
+        resource, make_input, _ = FLOWS[flow]
+        user_input = make_input(n, self.stubs.network_ids())
+        req = Request(flow)
+        self.requests[room_id] = req
+        data = {"id": "load-{}".format(n), "roomId": room_id, "personId": "load-user-{}".format(n),
+                "personEmail": "load{}@example.com".format(n)}
+        if resource == "messages":
+            self.stubs.messages[data["id"]] = dict(data, text=user_input, created="2020-01-01T00:00:00.000Z")
+        else:
+            data["messageId"] = "card-{}".format(n)
+            self.stubs.actions[data["id"]] = dict(data, type="submit", inputs=user_input)
+        req.sent_at = time.monotonic()
+        try:
+            req.status = requests.post(self.bot_url + "/", json={"resource": resource, "event": "created",
+                                                                 "data": data}, timeout=300).status_code
+        except requests.RequestException as e:
+            req.status = str(e)
+
+    def run(self, rate, duration, concurrency, timeout):
+        """
+        Send rate requests per second for duration seconds, cycling through
+        the flows, then wait up to timeout seconds for outstanding replies.
+        :return: Seconds from the first request to the last completion
+        """
+        count = max(1, int(rate * duration))
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for i, flow in zip(range(count), itertools.cycle(self.flows)):
+                delay = start + i / float(rate) - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(self.fire, flow)
+        deadline = time.monotonic() + timeout
+        with self._done:
+            while any(r.done_at is None for r in self.requests.values()) and time.monotonic() < deadline:
+                self._done.wait(0.5)
+        finished = [r.done_at for r in self.requests.values() if r.done_at is not None]
+        return (max(finished) if finished else time.monotonic()) - start
+
+    def report(self, elapsed):
+        print("{:<15} {:>5} {:>5} {:>9} {:>9} {:>9} {:>9} {:>8}".format(
+            "flow", "sent", "done", "first p50", "first p99", "done p50", "done p99", "req/s"))
+        for flow in self.flows:
+            reqs = [r for r in self.requests.values() if r.flow == flow]
+            first = [r.first_reply - r.sent_at for r in reqs if r.first_reply is not None]
+            done = [r.done_at - r.sent_at for r in reqs if r.done_at is not None]
+            print("{:<15} {:>5} {:>5} {:>9} {:>9} {:>9} {:>9} {:>8.2f}".format(
+                flow, len(reqs), len(done), fmt(percentile(first, 50)), fmt(percentile(first, 99)),
+                fmt(percentile(done, 50)), fmt(percentile(done, 99)), len(done) / elapsed if elapsed else 0))
+        errors = [r.status for r in self.requests.values() if r.status != 200]
+        if errors:
+            print("{} webhooks failed, e.g. {}".format(len(errors), errors[0]))
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1] if p < 100 else max(values)
+
+
+def fmt(seconds):
+    return "-" if seconds is None else "{:.3f}s".format(seconds)
+
+
+def start_bot(stub_url, port, production, meraki_api_version, env_overrides, workdir):
+    env = dict(os.environ)
+    env.update({
+        "WEBEX_API_URL": stub_url + "/webex/v1",
+        "MERAKI_API_URL": stub_url + "/meraki/api/" + meraki_api_version,
+        "UMBRELLA_API_URL": stub_url + "/umbrella/v1",
+        "REGISTER_WEBHOOKS": "false",
+        "COB_BOT_APP_NAME": "loadtest",
+        "COB_BOT_EMAIL": "bot@webex.bot",
+        "COB_BOT_TOKEN": "loadtest",
+        "MERAKI_API_KEY": "loadtest",
+        "UMBRELLA_MANAGEMENT_KEY": "loadtest",
+        "UMBRELLA_MANAGEMENT_SECRET": "loadtest",
+        "UMBRELLA_ORG_ID": "1",
+        "IMAGE_UPLOAD_URL": "http://127.0.0.1:{}/media/".format(port),
+        "MEDIA_PATH": workdir,
+        "COB_BOT_PORT": str(port),
+        "WEB_BIND": "127.0.0.1:{}".format(port)
+    })
+    env.update(env_overrides)
+    script = "server.py" if production else "bot.py"
+    bot = subprocess.Popen([sys.executable, os.path.join(CODE_DIR, script)], cwd=workdir, env=env)
+    url = "http://127.0.0.1:{}".format(port)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(url + "/health", timeout=1).status_code == 200:
+                return bot, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    bot.terminate()
+    raise RuntimeError("Bot did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--flows", default=",".join(FLOWS), help="Comma separated, from: " + ", ".join(FLOWS))
+    parser.add_argument("--rate", type=float, default=5, help="Webhooks per second")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of load")
+    parser.add_argument("--concurrency", type=int, default=64, help="Webhooks in flight at most")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds to wait for outstanding replies")
+    parser.add_argument("--bot-url", help="Drive an already running bot instead of starting one")
+    parser.add_argument("--bot-port", type=int, default=5055)
+    parser.add_argument("--production", action="store_true", help="Start server.py instead of bot.py")
+    parser.add_argument("--meraki-api-version", default="v0", help="v1 for Meraki SDKs that no longer accept v0")
+    parser.add_argument("--env", action="append", default=[], help="Extra KEY=VALUE for the bot, repeatable")
+    parser.add_argument("--stub-port", type=int, default=9000)
+    parser.add_argument("--orgs", type=int, default=1)
+    parser.add_argument("--networks", type=int, default=120)
+    parser.add_argument("--traffic-entries", type=int, default=2000)
+    parser.add_argument("--destinations", type=int, default=500)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--traffic-latency-ms", type=float, default=500)
+    args = parser.parse_args()
+
+    flows = [f for f in args.flows.split(",") if f]
+    unknown = [f for f in flows if f not in FLOWS]
+    if unknown:
+        parser.error("Unknown flows: {}".format(", ".join(unknown)))
+
+    stubs = StubUpstreams(args.orgs, args.networks, args.traffic_entries, args.destinations,
+                          args.latency_ms / 1000.0, args.traffic_latency_ms / 1000.0)
+    stub_url, stub_server = stubs.serve(port=args.stub_port)
+    print("Stub upstreams at {}".format(stub_url))
+
+    bot = None
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            if args.bot_url:
+                bot_url = args.bot_url
+            else:
+                overrides = dict(e.split("=", 1) for e in args.env)
+                bot, bot_url = start_bot(stub_url, args.bot_port, args.production, args.meraki_api_version,
+                                         overrides, workdir)
+            driver = LoadDriver(bot_url, stubs, flows)
+            elapsed = driver.run(args.rate, args.duration, args.concurrency, args.timeout)
+            driver.report(elapsed)
+        finally:
+            if bot is not None:
+                bot.terminate()
+                bot.wait()
+            stub_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
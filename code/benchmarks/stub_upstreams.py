@@ -0,0 +1,231 @@
+"""
+Local stand-ins for the Webex, Meraki and Umbrella APIs, returning
+realistic payloads of configurable size after a configurable latency.
+Every message the bot posts, edits or deletes is reported to a listener,
+which is how load_driver.py measures webhook-to-reply latency.
+
+Serve them on their own (then point the bot's WEBEX_API_URL, MERAKI_API_URL
+and UMBRELLA_API_URL at the printed URLs):
+
+    python benchmarks/stub_upstreams.py [--port 9000] [--networks 120] [--latency-ms 50]
+"""
+import argparse
+import itertools
+import random
+import threading
+import time
+
+from flask import Flask, abort, jsonify, request
+from werkzeug.serving import make_server
+
+APPLICATIONS = ("Miscellaneous web", "Miscellaneous secure web", "DNS", "Google HTTPS", "Office 365", "Webex")
+HOSTS = ("example.com", "cdn.example.net", "api.example.org", "static.example.io", "mail.example.com",
+         "video.example.tv", "docs.example.com", "updates.example.net")
+
+BOT_PERSON_ID = "stub-bot-person"
+
+
+class StubUpstreams(object):
+    """
+    One Flask app serving all three upstreams under /webex/v1,
+    /meraki/api/<version> and /umbrella/v1.
+    """
+
+    def __init__(self, orgs=1, networks=120, traffic_entries=2000, destinations=500,
+                 latency=0.05, traffic_latency=0.5, jitter=0.2, listener=None, seed=1):
+        """
+        :param orgs: Meraki organizations
+        :param networks: Networks per organization
+        :param traffic_entries: Entries per getNetworkTraffic response
+        :param destinations: Destinations on each Umbrella list
+        :param latency: Seconds added to every response
+        :param traffic_latency: Seconds added to getNetworkTraffic instead
+        :param jitter: Random extra latency as a fraction of the base
+        :param listener: Callable taking (event, room id, message dict) for
+                "post", "edit" and "delete" of Webex messages
+        """
+        self.orgs = ["org_{}".format(o) for o in range(orgs)]
+        self.networks = dict((org, ["N_{}_{}".format(o, n) for n in range(networks)])
+                             for o, org in enumerate(self.orgs))
+        self.traffic_entries = traffic_entries
+        self.destinations = destinations
+        self.latency = latency
+        self.traffic_latency = traffic_latency
+        self.jitter = jitter
+        self.listener = listener
+        self.random = random.Random(seed)
+        self._traffic = {}
+        # Messages and card actions the driver registers before firing the
+        # webhook that refers to them
+        self.messages = {}
+        self.actions = {}
+        self._posted = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.app = self._build()
+
+    def network_ids(self):
+        return [n for org in self.orgs for n in self.networks[org]]
+
+    def _sleep(self, base):
+        if base > 0:
+            time.sleep(base * (1 + self.random.uniform(0, self.jitter)))
+
+    def _notify(self, event, room_id, message):
+        if self.listener is not None:
+            self.listener(event, room_id, message)
+
+    def _network_traffic(self, network_id):
+        # Generated once per network so repeated calls chart the same data
+        with self._lock:
+            traffic = self._traffic.get(network_id)
+            if traffic is None:
+                rnd = random.Random(network_id)
+                traffic = [{
+                    "application": rnd.choice(APPLICATIONS),
+                    "destination": ("{}.{}".format(rnd.randrange(500), rnd.choice(HOSTS)) if rnd.random() < 0.7
+                                    else "10.{}.{}.{}".format(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))),
+                    "protocol": rnd.choice(("TCP", "UDP")),
+                    "port": rnd.choice((53, 80, 443)),
+                    "sent": rnd.randrange(1, 10 ** 6),
+                    "recv": rnd.randrange(1, 10 ** 7),
+                    "numClients": rnd.randrange(1, 50),
+                    "activeTime": rnd.randrange(1, 86400),
+                    "flows": rnd.randrange(1, 1000)
+                } for _ in range(self.traffic_entries)]
+                self._traffic[network_id] = traffic
+        return traffic
+
+    def _build(self):
+        app = Flask("stub_upstreams")
+
+        # Webex
+        @app.route("/webex/v1/people/me")
+        def webex_me():
+            self._sleep(self.latency)
+            return jsonify({"id": BOT_PERSON_ID, "displayName": "Cloud Operations Bot",
+                            "emails": ["bot@webex.bot"]})
+
+        @app.route("/webex/v1/people/<person_id>")
+        def webex_person(person_id):
+            self._sleep(self.latency)
+            return jsonify({"id": person_id, "firstName": "Load", "displayName": "Load Test",
+                            "emails": ["{}@example.com".format(person_id)]})
+
+        @app.route("/webex/v1/messages/<message_id>", methods=["GET", "PUT", "DELETE"])
+        def webex_message(message_id):
+            self._sleep(self.latency)
+            if request.method == "GET":
+                message = self.messages.get(message_id)
+                if message is None:
+                    abort(404)
+                return jsonify(message)
+            with self._lock:
+                room_id = self._posted.get(message_id)
+            if room_id is None:
+                abort(404)
+            if request.method == "DELETE":
+                self._notify("delete", room_id, {"id": message_id})
+                return "", 204
+            message = dict(request.get_json(), id=message_id)
+            self._notify("edit", room_id, message)
+            return jsonify(message)
+
+        @app.route("/webex/v1/messages", methods=["POST"])
+        def webex_post_message():
+            self._sleep(self.latency)
+            message = dict(request.get_json(force=True), id="posted-{}".format(next(self._ids)),
+                           personId=BOT_PERSON_ID)
+            with self._lock:
+                self._posted[message["id"]] = message["roomId"]
+            self._notify("post", message["roomId"], message)
+            return jsonify(message)
+
+        @app.route("/webex/v1/attachment/actions/<action_id>")
+        def webex_action(action_id):
+            self._sleep(self.latency)
+            action = self.actions.get(action_id)
+            if action is None:
+                abort(404)
+            return jsonify(action)
+
+        # Meraki
+        # Any API version, so the stubs work with old and new SDKs
+        @app.route("/meraki/api/<version>/organizations")
+        def meraki_orgs(version):
+            self._sleep(self.latency)
+            return jsonify([{"id": org, "name": "Organization {}".format(org)} for org in self.orgs])
+
+        @app.route("/meraki/api/<version>/organizations/<org_id>/networks")
+        def meraki_networks(version, org_id):
+            self._sleep(self.latency)
+            return jsonify([{"id": n, "organizationId": org_id, "name": "Branch {}".format(n), "timeZone": "UTC"}
+                            for n in self.networks.get(org_id, [])])
+
+        @app.route("/meraki/api/<version>/networks/<network_id>/traffic")
+        def meraki_traffic(version, network_id):
+            self._sleep(self.traffic_latency)
+            return jsonify(self._network_traffic(network_id))
+
+        # Umbrella
+        @app.route("/umbrella/v1/organizations/<org_id>/destinationlists")
+        def umbrella_lists(org_id):
+            self._sleep(self.latency)
+            return jsonify({"status": {"code": 200}, "data": [
+                {"id": 1, "name": "Block List", "access": "block"},
+                {"id": 2, "name": "Allow List", "access": "allow"}
+            ]})
+
+        @app.route("/umbrella/v1/organizations/<org_id>/destinationlists/<list_id>/destinations",
+                   methods=["GET", "POST"])
+        def umbrella_destinations(org_id, list_id):
+            self._sleep(self.latency)
+            if request.method == "POST":
+                return jsonify({"status": {"code": 200}, "data": {"id": int(list_id)}})
+            page = int(request.args.get("page", 1))
+            limit = int(request.args.get("limit", 100))
+            start = (page - 1) * limit
+            end = min(start + limit, self.destinations)
+            return jsonify({"status": {"code": 200}, "data": [
+                {"id": str(i), "destination": "listed{}.example.com".format(i), "type": "DOMAIN"}
+                for i in range(start, end)
+            ]})
+
+        return app
+
+    def serve(self, host="127.0.0.1", port=9000):
+        """
+        Serve in a background thread.
+        :return: (base URL, werkzeug server); call server.shutdown() to stop
+        """
+        server = make_server(host, port, self.app, threaded=True)
+        threading.Thread(target=server.serve_forever, name="stub-upstreams", daemon=True).start()
+        return "http://{}:{}".format(host, server.server_port), server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--orgs", type=int, default=1)
+    parser.add_argument("--networks", type=int, default=120)
+    parser.add_argument("--traffic-entries", type=int, default=2000)
+    parser.add_argument("--destinations", type=int, default=500)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--traffic-latency-ms", type=float, default=500)
+    args = parser.parse_args()
+
+    stubs = StubUpstreams(args.orgs, args.networks, args.traffic_entries, args.destinations,
+                          args.latency_ms / 1000.0, args.traffic_latency_ms / 1000.0)
+    url, server = stubs.serve(port=args.port)
+    print("WEBEX_API_URL={}/webex/v1".format(url))
+    print("MERAKI_API_URL={}/meraki/api/v0".format(url))
+    print("UMBRELLA_API_URL={}/umbrella/v1".format(url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,34 @@
+import atexit
 import base64
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from cache import TTLCache
+import cards
+from charts import ChartCache
+from clients import ClientPool, UpstreamPolicy
+from idempotency import IdempotencyStore, SQLiteIdempotencyBackend, SharedIdempotencyBackend
+from idempotency import forget as forget_result
 from dotenv import load_dotenv
-import io 
+import functools
+import hashlib
 import json
-import matplotlib.pyplot as plt
-import meraki
+import metrics
+from multiprocessing.util import Finalize
+import progress
+from progress import Progress
+from prefetch import ChartPrefetcher, describe_age
+from network_index import NetworkIndex, NetworkIndexRefresher
 import os
-import requests
+import signal
 import sys
-from webexteamsbot import TeamsBot
-from webexteamsbot.models import Response
+import time
+from ratelimit import UpstreamUnavailable
+from scheduler import Busy, FairScheduler
+from shared import LeaderLease, RoomSequencer, create_backend
+import umbrella
+from umbrella_index import DestinationIndex
+from traffic import DEFAULT_APPLICATIONS, TrafficAggregator, aggregate_traffic
+from traffic_store import TrafficSnapshotter, TrafficStore, describe_span
+from workers import WorkerPool
 
 load_dotenv()
 
@@ -24,20 +44,265 @@ umbrella_org_id = os.getenv("UMBRELLA_ORG_ID")
 image_upload_url = os.getenv("IMAGE_UPLOAD_URL")
 media_path = os.getenv("MEDIA_PATH")
 
-# Create a Bot Object
-bot = TeamsBot(
-    bot_app_name,
-    teams_bot_token=teams_token,
-    teams_bot_url=bot_url,
-    teams_bot_email=bot_email,
-    webhook_resource_event=[{"resource": "messages", "event": "created"},
-                            {"resource": "attachmentActions", "event": "created"}]
+# Upstream API base URLs, overridable to point the bot at stub servers for
+# load tests. The Meraki SDK's own default is used unless MERAKI_API_URL is
+# set.
+webex_api_url = os.getenv("WEBEX_API_URL", "https://api.ciscospark.com/v1").rstrip("/")
+meraki_api_url = os.getenv("MERAKI_API_URL")
+umbrella_api_url = os.getenv("UMBRELLA_API_URL", "https://management.api.umbrella.com/v1").rstrip("/")
+
+# Port of Flask's development server (python bot.py)
+bot_port = int(os.getenv("COB_BOT_PORT", "5000"))
+
+# State shared by several worker processes or hosts: backend ("sqlite", or
+# "module:callable" for one implemented elsewhere; empty keeps everything
+# per process) and its location, how long one room's work may hold the room
+# and how long the elected leader's lease lasts
+shared_backend_name = os.getenv("SHARED_BACKEND", "")
+shared_backend_location = os.getenv("SHARED_BACKEND_LOCATION", "shared")
+# Worker processes only see each other's claimed submissions through a
+# shared backend
+if not shared_backend_name and os.getenv("EXECUTION_MODE") == "process":
+    shared_backend_name = "sqlite"
+room_lock_ttl = int(os.getenv("ROOM_LOCK_TTL", "120"))
+leader_ttl = int(os.getenv("LEADER_TTL", "30"))
+
+# The SQLite backend keeps chart images under MEDIA_PATH, where
+# IMAGE_UPLOAD_URL already serves them; any other backend holds them itself
+# and they are served from the bot's /media/ path
+shared_backend_options = {"blob_path": media_path} if shared_backend_name == "sqlite" and media_path else {}
+
+shared = (create_backend(shared_backend_name, shared_backend_location, **shared_backend_options)
+          if shared_backend_name else None)
+
+
+def shared_path(path):
+    # With the SQLite backend the local indexes and traffic store live in
+    # its directory too (relative paths only), so every worker and every
+    # host mounting it sees the leader's refreshes and snapshots
+    if shared_backend_name == "sqlite" and not os.path.isabs(path):
+        return os.path.join(shared_backend_location, path)
+    return path
+
+
+# Seconds between publishing this process's metrics to the shared backend,
+# where /metrics sums every process's
+metrics_publish_interval = int(os.getenv("METRICS_PUBLISH_INTERVAL", "15"))
+
+shared_metrics = metrics.SharedMetrics(shared, interval=metrics_publish_interval) if shared is not None else None
+
+# Replies to one room are never interleaved; each scheduled request holds
+# its room while it runs
+rooms = RoomSequencer(shared, ttl=room_lock_ttl, timeout=room_lock_ttl)
+
+# Cache settings (seconds) for slow-changing lookups
+cache_max_entries = int(os.getenv("CACHE_MAX_ENTRIES", "256"))
+cache_stale_ttl = int(os.getenv("CACHE_STALE_TTL", "86400"))
+meraki_networks_ttl = int(os.getenv("MERAKI_NETWORKS_TTL", "900"))
+umbrella_lists_ttl = int(os.getenv("UMBRELLA_LISTS_TTL", "900"))
+
+cache = TTLCache(max_entries=cache_max_entries, backend=shared)
+
+# Pooled, keep-alive HTTP clients shared by every outbound call
+http_pool_size = int(os.getenv("HTTP_POOL_SIZE", "10"))
+http_timeout = int(os.getenv("HTTP_TIMEOUT", "30"))
+
+# Process-wide rate limits (requests per second) per upstream and per Meraki
+# org, retries on 429/5xx, and circuit breaker settings
+upstream_max_retries = int(os.getenv("UPSTREAM_MAX_RETRIES", "3"))
+breaker_failure_threshold = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+breaker_reset_timeout = int(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+meraki_org_rate_limit = float(os.getenv("MERAKI_ORG_RATE_LIMIT", "5"))
+
+
+def upstream_policy(rate):
+    return UpstreamPolicy(rate=rate, max_retries=upstream_max_retries,
+                          failure_threshold=breaker_failure_threshold,
+                          reset_timeout=breaker_reset_timeout)
+
+
+clients = ClientPool(
+    teams_token,
+    meraki_api_key,
+    umbrella_management_key,
+    umbrella_management_secret,
+    pool_size=http_pool_size,
+    timeout=http_timeout,
+    policies={
+        "webex": upstream_policy(float(os.getenv("WEBEX_RATE_LIMIT", "10"))),
+        "meraki": upstream_policy(float(os.getenv("MERAKI_RATE_LIMIT", "10"))),
+        "umbrella": upstream_policy(float(os.getenv("UMBRELLA_RATE_LIMIT", "10")))
+    },
+    meraki_org_rate=meraki_org_rate_limit,
+    meraki_base_url=meraki_api_url
+)
+
+# Local index of every org and network for /network searches; the networks
+# card switches to a search box past network_card_max_choices networks
+network_index_path = shared_path(os.getenv("NETWORK_INDEX_PATH", "network_index.db"))
+network_index_refresh = int(os.getenv("NETWORK_INDEX_REFRESH", "900"))
+network_card_max_choices = int(os.getenv("NETWORK_CARD_MAX_CHOICES", "100"))
+network_search_page_size = int(os.getenv("NETWORK_SEARCH_PAGE_SIZE", "20"))
+
+network_index = NetworkIndex(network_index_path)
+
+# Bulk Umbrella adds: destinations per POST and concurrent POSTs
+umbrella_bulk_chunk_size = int(os.getenv("UMBRELLA_BULK_CHUNK_SIZE", "500"))
+umbrella_bulk_parallel = int(os.getenv("UMBRELLA_BULK_PARALLEL", "4"))
+
+# Local index of destination list contents used for duplicate checks, and
+# how old (seconds) a list's copy may get before it is read again in the
+# background; the old copy keeps answering until the read completes
+umbrella_index_path = shared_path(os.getenv("UMBRELLA_INDEX_PATH", "umbrella_index.db"))
+umbrella_page_size = int(os.getenv("UMBRELLA_PAGE_SIZE", "100"))
+umbrella_index_max_age = int(os.getenv("UMBRELLA_INDEX_MAX_AGE", "3600"))
+
+destination_index = DestinationIndex(umbrella_index_path, max_age=umbrella_index_max_age)
+
+# Org-wide traffic: which orgs to cover (default: every org the key can see)
+# and how many getNetworkTraffic calls may be in flight. Each call still
+# waits on its org's rate limiter in the Meraki client.
+meraki_org_ids = [o for o in os.getenv("MERAKI_ORG_IDS", "").split(",") if o]
+meraki_max_concurrency = int(os.getenv("MERAKI_MAX_CONCURRENCY", "8"))
+
+# Applications whose destinations are charted (comma separated, "*" for all)
+# and how many top destinations to keep
+traffic_applications = os.getenv("TRAFFIC_APPLICATIONS", ",".join(DEFAULT_APPLICATIONS))
+traffic_applications = [] if traffic_applications == "*" else [a for a in traffic_applications.split(",") if a]
+traffic_top_k = int(os.getenv("TRAFFIC_TOP_K", "10"))
+
+# Historical traffic snapshots: which networks to capture (comma separated
+# ids, "*" for every indexed network, empty to disable), how often, how many
+# at once and for how long to keep them
+traffic_store_path = shared_path(os.getenv("TRAFFIC_STORE_PATH", "traffic_store.db"))
+traffic_snapshot_networks = os.getenv("TRAFFIC_SNAPSHOT_NETWORKS", "")
+traffic_snapshot_interval = int(os.getenv("TRAFFIC_SNAPSHOT_INTERVAL", "7200"))
+traffic_snapshot_workers = int(os.getenv("TRAFFIC_SNAPSHOT_WORKERS", "4"))
+traffic_retention_days = int(os.getenv("TRAFFIC_RETENTION_DAYS", "30"))
+
+traffic_store = TrafficStore(traffic_store_path)
+
+# Rendered charts: how many images to keep under MEDIA_PATH and how many
+# processes render them
+chart_cache_entries = int(os.getenv("CHART_CACHE_ENTRIES", "64"))
+chart_render_workers = int(os.getenv("CHART_RENDER_WORKERS", "2"))
+
+charts = ChartCache(media_path, max_entries=chart_cache_entries, render_workers=chart_render_workers,
+                    store=shared)
+atexit.register(charts.shutdown)
+
+# De-duplication of redelivered webhooks and repeated card submissions
+idempotency_ttl = int(os.getenv("IDEMPOTENCY_TTL", "300"))
+idempotency_max_entries = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+idempotency_db = os.getenv("IDEMPOTENCY_DB")
+
+idempotency = IdempotencyStore(
+    max_entries=idempotency_max_entries,
+    ttl=idempotency_ttl,
+    backend=SharedIdempotencyBackend(shared, claim_ttl=idempotency_ttl) if shared is not None
+    else SQLiteIdempotencyBackend(idempotency_db) if idempotency_db else None
+)
+
+# Optional per-request trace log (JSON lines) of every stage's latency
+trace_log = metrics.TraceLog(os.getenv("TRACE_LOG"))
+
+# Chart prefetching: refresh interval (0 disables), networks always kept
+# warm, how many of the most requested networks to add, random start delay
+# and concurrency per round
+prefetch_interval = int(os.getenv("PREFETCH_INTERVAL", "600"))
+prefetch_networks = [n for n in os.getenv("PREFETCH_NETWORKS", "").split(",") if n]
+prefetch_top_n = int(os.getenv("PREFETCH_TOP_N", "10"))
+prefetch_jitter = float(os.getenv("PREFETCH_JITTER", "60"))
+prefetch_workers = int(os.getenv("PREFETCH_WORKERS", "2"))
+
+# Startup: whether to create/update the Webex webhooks (skip when they are
+# managed elsewhere) and whether to warm up caches, clients and chart
+# rendering before serving
+register_webhooks = os.getenv("REGISTER_WEBHOOKS", "true").lower() == "true"
+warm_up_on_start = os.getenv("WARM_UP", "false").lower() == "true"
+
+# Progressive replies: post a placeholder at once for slow operations, edit
+# it with progress at most every PROGRESS_UPDATE_INTERVAL seconds, then
+# replace it with the result
+progressive_replies = os.getenv("PROGRESSIVE_REPLIES", "true").lower() == "true"
+progress_update_interval = float(os.getenv("PROGRESS_UPDATE_INTERVAL", "3"))
+
+# Execution mode for card actions: "inline" handles them inside the webhook
+# request, "thread" or "process" acknowledges the webhook immediately and
+# runs the handler on a background worker pool. "process" uses the shared
+# backend ("sqlite" unless SHARED_BACKEND says otherwise) so a submission
+# claimed by one worker process is seen by the others.
+execution_mode = os.getenv("EXECUTION_MODE", "inline")
+worker_count = int(os.getenv("WORKER_COUNT", "4"))
+worker_queue_depth = int(os.getenv("WORKER_QUEUE_DEPTH", "100"))
+# Threads that fetch a card action off the webhook request in a worker
+# execution mode, so it can be classified before it is admitted
+card_fetch_workers = int(os.getenv("CARD_FETCH_WORKERS", "2"))
+
+
+def init_worker():
+    # Runs once in each worker: a forked process opens its own connections
+    # and publishes the metrics of the jobs it runs. A worker process exits
+    # without running atexit handlers, after waiting for its own children,
+    # so its chart render processes are stopped by a finalizer instead; it
+    # must run before the finalizers that close the pool's queues.
+    clients.reset()
+    if execution_mode == "process":
+        Finalize(None, charts.shutdown, exitpriority=100)
+        if shared_metrics is not None:
+            shared_metrics.start()
+
+
+workers = None
+card_fetchers = None
+if execution_mode != "inline":
+    workers = WorkerPool(
+        mode=execution_mode,
+        max_workers=worker_count,
+        max_queue=worker_queue_depth,
+        initializer=init_worker
+    )
+    atexit.register(workers.shutdown)
+    card_fetchers = WorkerPool(
+        mode="thread",
+        max_workers=card_fetch_workers,
+        max_queue=worker_queue_depth
+    )
+    atexit.register(card_fetchers.shutdown)
+
+# Admission control for commands and card actions, per process: requests
+# running at once, requests waiting for a slot, requests queued or running
+# per room and per user, and the weight of each cost class ("class=weight,
+# ...") - a light request is served weight/heavy weight times as often as
+# a heavy one. Requests past a limit get a busy reply instead of queueing.
+# In a worker execution mode no more than WORKER_COUNT requests run at
+# once, so waiting requests stay in fair order instead of the pool's FIFO.
+max_in_flight = int(os.getenv("MAX_IN_FLIGHT", "8"))
+if workers is not None:
+    max_in_flight = min(max_in_flight, worker_count)
+admission_queue_depth = int(os.getenv("ADMISSION_QUEUE_DEPTH", "50"))
+room_max_requests = int(os.getenv("ROOM_MAX_REQUESTS", "2"))
+user_max_requests = int(os.getenv("USER_MAX_REQUESTS", "3"))
+scheduler_weights = os.getenv("SCHEDULER_WEIGHTS", "light=4,heavy=1")
+
+scheduler = FairScheduler(
+    max_in_flight=max_in_flight,
+    max_queue=admission_queue_depth,
+    room_limit=room_max_requests,
+    user_limit=user_max_requests,
+    weights=dict((name.strip(), float(weight)) for name, weight in
+                 (w.split("=", 1) for w in scheduler_weights.split(",") if w.strip()))
 )
 
+# The bot object, built by create_app()
+bot = None
+
 
 # Create a custom bot greeting function returned when no command is given.
 # The default behavior of the bot is to return the '/help' command response
 def greeting(incoming_msg):
+    from webexteamsbot.models import Response
+
     # Loopkup details about sender
     sender = bot.teams.people.get(incoming_msg.personId)
 
@@ -48,425 +313,745 @@ def greeting(incoming_msg):
     return response
 
 
+@metrics.timed("umbrella_get_destination_lists")
 def get_umbrella_destination_lists():
-    r = requests.get(
-        'https://management.api.umbrella.com/v1/organizations/{}/destinationlists'.format(umbrella_org_id), 
-        auth=requests.auth.HTTPBasicAuth(umbrella_management_key, umbrella_management_secret)
+    r = clients.umbrella().get(
+        '{}/organizations/{}/destinationlists'.format(umbrella_api_url, umbrella_org_id)
     ).json()
     dest_lists = [(dest_list["name"], dest_list["id"]) for dest_list in r["data"]]
     return dest_lists
 
 
+def get_umbrella_destination_pages(destination_list):
+    # Yields one page of destination strings at a time
+    page = 1
+    while True:
+        with metrics.track("umbrella_get_destinations_page"):
+            r = clients.umbrella().get(
+                '{}/organizations/{}/destinationlists/{}/destinations'.format(umbrella_api_url, umbrella_org_id, destination_list),
+                params={"page": page, "limit": umbrella_page_size}
+            ).json()
+        data = r.get("data", [])
+        yield [d["destination"] for d in data]
+        if len(data) < umbrella_page_size:
+            break
+        page += 1
+
+
+def load_destination_index(destination_list):
+    destination_index.ensure_loaded(destination_list, lambda: get_umbrella_destination_pages(destination_list))
+
+
+@metrics.timed("umbrella_add_destination")
 def add_domain_to_destination_list(domain, destination_list):
     payload = [{"destination": domain}]
-    r = requests.post(
-        'https://management.api.umbrella.com/v1/organizations/{}/destinationlists/{}/destinations'.format(umbrella_org_id, destination_list),
-        json=payload,
-        auth=requests.auth.HTTPBasicAuth(umbrella_management_key, umbrella_management_secret)
+    r = clients.umbrella().post(
+        '{}/organizations/{}/destinationlists/{}/destinations'.format(umbrella_api_url, umbrella_org_id, destination_list),
+        json=payload
     )
+    if r.status_code == 200:
+        destination_index.add(destination_list, [domain])
     return r.status_code
 
 
+@metrics.timed("umbrella_add_destinations")
+def add_domains_to_destination_list(domains, destination_list):
+    added, failed = umbrella.bulk_add_destinations(
+        clients.umbrella(),
+        '{}/organizations/{}/destinationlists/{}/destinations'.format(umbrella_api_url, umbrella_org_id, destination_list),
+        domains,
+        chunk_size=umbrella_bulk_chunk_size,
+        max_parallel=umbrella_bulk_parallel,
+        on_progress=lambda done, total: progress.report("Added {}/{} destinations...".format(done, total))
+    )
+    destination_index.add(destination_list, added)
+    return added, failed
+
+
+def bulk_add_domains(text, destination_list):
+    """
+    Normalize a pasted or uploaded domain list and add the domains not
+    already on the destination list.
+    :param text: Raw domain list
+    :param destination_list: Destination list id
+    :return: Markdown summary of successes and failures
+    """
+    domains, invalid = umbrella.normalize_domains(text)
+    load_destination_index(destination_list)
+    missing = destination_index.missing(destination_list, domains)
+    added, failed = add_domains_to_destination_list(missing, destination_list)
+    if failed:
+        # Submitting the same list again retries the failures
+        forget_result()
+    return umbrella.bulk_summary(destination_list_name(destination_list), added, failed, invalid,
+                                 present=len(domains) - len(missing))
+
+
+def sync_domains(text, destination_list):
+    """
+    Diff a domain list against the indexed destination list and send only
+    the missing entries.
+    :param text: Raw domain list
+    :param destination_list: Destination list id
+    :return: Markdown summary of the diff and the adds
+    """
+    summary = bulk_add_domains(text, destination_list)
+    domains, _ = umbrella.normalize_domains(text)
+    extra = destination_index.extra(destination_list, domains)
+    if extra:
+        summary += "  \n{} destinations on the list are not in the file (left in place).".format(extra)
+    return summary
+
+
+def destination_list_name(destination_list):
+    names = dict((str(list_id), name) for name, list_id in cached_umbrella_destination_lists())
+    return names.get(str(destination_list), destination_list)
+
+
+@metrics.timed("meraki_get_org_networks")
 def get_meraki_org_networks():
-    dashboard = meraki.DashboardAPI(meraki_api_key, output_log=False)
+    dashboard = clients.meraki()
     orgs = dashboard.organizations.getOrganizations()
     org = orgs[0]["id"]
     networks = dashboard.networks.getOrganizationNetworks(org)
+    clients.register_networks(org, [network["id"] for network in networks])
+    return [(network["name"], network["id"]) for network in networks]
+
+
+@metrics.timed("meraki_get_organizations")
+def list_meraki_orgs():
+    return [(org["name"], org["id"]) for org in clients.meraki().organizations.getOrganizations()]
+
+
+@metrics.timed("meraki_get_org_networks")
+def list_meraki_networks(org_id):
+    networks = clients.meraki().networks.getOrganizationNetworks(org_id)
+    clients.register_networks(org_id, [network["id"] for network in networks])
     return [(network["name"], network["id"]) for network in networks]
 
 
 def get_meraki_network_traffic(network_id):
-    dashboard = meraki.DashboardAPI(meraki_api_key, output_log=False)
-    network_traffic = dashboard.networks.getNetworkTraffic(network_id, timespan=86400)
-    destinations_and_totals = {}
-    for entry in network_traffic:
-        if entry["application"] == "Miscellaneous web" or entry["application"] == "Miscellaneous secure web":
-            if any(c.isalpha() for c in entry["destination"]):
-                if entry["destination"] not in destinations_and_totals:
-                    destinations_and_totals[entry["destination"]] = entry["sent"] + entry["recv"]
-                else:
-                    destinations_and_totals[entry["destination"]] = destinations_and_totals[entry["destination"]] + entry["sent"] + entry["recv"]
-    network_traffic_desc = sorted(destinations_and_totals.items(), key=lambda x: x[1], reverse=True)
-    return network_traffic_desc
+    dashboard = clients.meraki()
+    with metrics.track("meraki_get_network_traffic"):
+        network_traffic = dashboard.networks.getNetworkTraffic(network_id, timespan=86400)
+    progress.report("Fetched {} traffic entries, building the chart...".format(len(network_traffic)))
+    with metrics.track("traffic_aggregation"):
+        return aggregate_traffic(network_traffic, traffic_applications, traffic_top_k)
+
+
+@metrics.timed("meraki_get_all_networks")
+def get_meraki_all_networks(org_ids=None):
+    """
+    List networks across several organizations.
+    :param org_ids: Organization ids, defaults to every org the key can see
+    :return: List of (org_id, network_id) tuples
+    """
+    dashboard = clients.meraki()
+    if not org_ids:
+        org_ids = [org["id"] for org in dashboard.organizations.getOrganizations()]
+    networks = []
+    for org_id in org_ids:
+        org_networks = [network["id"] for network in dashboard.networks.getOrganizationNetworks(org_id)]
+        clients.register_networks(org_id, org_networks)
+        networks += [(org_id, network_id) for network_id in org_networks]
+    return networks
+
+
+@metrics.timed("meraki_org_wide_traffic")
+def get_meraki_org_wide_traffic(org_ids=None):
+    """
+    Aggregate top destinations across every network of the given orgs.
+    getNetworkTraffic calls fan out over a bounded thread pool, each one
+    waiting on its org's rate limiter in the client, and totals are merged
+    as responses arrive.
+    :param org_ids: Organization ids, defaults to every org the key can see
+    :return: List of (destination, total bytes) sorted descending
+    """
+    dashboard = clients.meraki()
+    networks = get_meraki_all_networks(org_ids)
+
+    def fetch(network_id):
+        return dashboard.networks.getNetworkTraffic(network_id, timespan=86400)
+
+    aggregator = TrafficAggregator(traffic_applications)
+    skipped = 0
+    progress.report("Found {} networks, fetching traffic...".format(len(networks)))
+    with ThreadPoolExecutor(max_workers=meraki_max_concurrency) as pool:
+        futures = [pool.submit(fetch, network_id) for org_id, network_id in networks]
+        for done, future in enumerate(as_completed(futures), 1):
+            progress.report("Fetched {}/{} networks...".format(done, len(networks)))
+            try:
+                network_traffic = future.result()
+            except UpstreamUnavailable:
+                # Fail fast: don't wait for the queued calls on the way out
+                for pending in futures:
+                    pending.cancel()
+                raise
+            except Exception as e:
+                # Networks without traffic analysis enabled return an error
+                skipped += 1
+                sys.stderr.write("Skipping network traffic: {}\n".format(e))
+                continue
+            with metrics.track("traffic_aggregation"):
+                aggregator.add(network_traffic)
+    if skipped:
+        sys.stderr.write("Org-wide traffic skipped {} of {} networks\n".format(skipped, len(networks)))
+    return aggregator.top(traffic_top_k)
+
+
+# Cached wrappers: cards are rendered from the cache and stale entries are
+# refreshed in the background, so picking an operation doesn't wait on the
+# Meraki or Umbrella APIs once the cache is warm.
+def cached_meraki_org_networks():
+    return cache.get("meraki_org_networks", get_meraki_org_networks,
+                     ttl=meraki_networks_ttl, stale_ttl=cache_stale_ttl)
+
+
+def cached_umbrella_destination_lists():
+    return cache.get("umbrella_destination_lists", get_umbrella_destination_lists,
+                     ttl=umbrella_lists_ttl, stale_ttl=cache_stale_ttl)
+
+
+def refresh_caches(incoming_msg):
+    """
+    Drop cached Meraki networks and Umbrella destination lists and reload
+    them in the background.
+    :param incoming_msg: The incoming message object from Teams
+    :return: A text or markdown based reply
+    """
+    cache.invalidate()
+    destination_index.invalidate()
+    cache.refresh("meraki_org_networks", get_meraki_org_networks,
+                  ttl=meraki_networks_ttl, stale_ttl=cache_stale_ttl)
+    cache.refresh("umbrella_destination_lists", get_umbrella_destination_lists,
+                  ttl=umbrella_lists_ttl, stale_ttl=cache_stale_ttl)
+    return "Cached networks and destination lists cleared, reloading now."
 
 
+@metrics.timed("traffic_chart")
 def generate_network_traffic_chart(network_traffic_desc):
-    top10_dests = network_traffic_desc[:10]
-    labels = [dest[0] for dest in top10_dests]
-    values = [dest[1] for dest in top10_dests]
-    plt.switch_backend('agg')
-    patches, texts = plt.pie(values, startangle=90)
-    plt.legend(patches, labels, bbox_to_anchor=(1,0.5), loc="center right", fontsize=10, bbox_transform=plt.gcf().transFigure)
-    plt.subplots_adjust(left=0.0, bottom=0.1, right=0.55)
-    plt.savefig(media_path + 'network_traffic.png')
-    return "network_traffic.png"
-
-
-# This function generates a basic adaptive card and sends it to the user
-# You can use Microsofts Adaptive Card designer here:
-# https://adaptivecards.io/designer/. The formatting that Webex Teams
-# uses isn't the same, but this still helps with the overall layout
-# make sure to take the data that comes out of the MS card designer and
-# put it inside of the "content" below, otherwise Webex won't understand
-# what you send it.
+    return charts.image_name(network_traffic_desc[:traffic_top_k])
+
+
+# These functions send the Adaptive Cards defined in cards.py. The card
+# skeletons are built once at startup and only the dynamic parts (choice
+# lists, chart URL) are spliced in per request.
 def show_operations_card(incoming_msg):
-    attachment = '''
-    {
-        "contentType": "application/vnd.microsoft.card.adaptive",
-        "content": {
-            "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
-            "type": "AdaptiveCard",
-            "version": "1.0",
-            "body": [
-                {
-                    "type": "ColumnSet",
-                    "columns": [
-                        {
-                            "type": "Column",
-                            "width": 2,
-                            "items": [
-                                {
-                                    "type": "TextBlock",
-                                    "text": "Choose an Operation",
-                                    "weight": "Bolder",
-                                    "size": "Medium"
-                                },
-                                {
-                                    "type": "Input.Text",
-                                    "placeholder": "Placeholder text",
-                                    "isVisible": false,
-                                    "id": "card_type",
-                                    "value": "choose_operation"
-                                },
-                                {
-                                    "type": "TextBlock",
-                                    "text": "Select an operation to perform across your Cisco cloud-based products.",
-                                    "isSubtle": true,
-                                    "wrap": true
-                                },
-                                {
-                                    "type": "Input.ChoiceSet",
-                                    "id": "operation",
-                                    "placeholder": "Choose an operation...",
-                                    "choices": [
-                                        {
-                                            "title": "View Meraki Traffic",
-                                            "value": "meraki_network_traffic"
-                                        },
-                                        {
-                                            "title": "Add Umbrella Domain Policy",
-                                            "value": "umbrella_destination"
-                                        }
-                                    ]
-                                }
-                            ]
-                        }
-                    ]
-                }
-            ],
-            "actions": [
-                {
-                    "type": "Action.Submit",
-                    "title": "Submit"
-                }
-            ]
-        }
-    }
-    '''
-    backupmessage = "This is an example using Adaptive Cards."
-
-    c = create_message_with_attachment(incoming_msg.roomId,
-                                       msgtxt=backupmessage,
-                                       attachment=json.loads(attachment))
-    print(c)
-    return ""
+    return send_card(incoming_msg.roomId, cards.OPERATIONS_CARD_JSON)
 
 
 def show_meraki_networks_card(roomId):
-    attachment_start = '''
-    {
-        "contentType": "application/vnd.microsoft.card.adaptive",
-        "content": {
-            "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
-            "type": "AdaptiveCard",
-            "version": "1.0",
-            "body": [
-                {
-                    "type": "ColumnSet",
-                    "columns": [
-                        {
-                            "type": "Column",
-                            "width": 2,
-                            "items": [
-                                {
-                                    "type": "TextBlock",
-                                    "text": "Choose a Network",
-                                    "weight": "Bolder",
-                                    "size": "Medium"
-                                },
-                                {
-                                    "type": "Input.Text",
-                                    "placeholder": "Placeholder text",
-                                    "isVisible": false,
-                                    "id": "card_type",
-                                    "value": "meraki_choose_network"
-                                },
-                                {
-                                    "type": "TextBlock",
-                                    "size": "Small",
-                                    "text": "Network"
-                                },
-                                {
-                                    "type": "Input.ChoiceSet",
-                                    "id": "network_id",
-                                    "placeholder": "Choose an organization network...",
-                                    "choices": [
-    '''
-    attachment_insert = ''''''
-    networks = get_meraki_org_networks()
-    for network in networks:
-        attachment_insert += '''
-        {
-            "title": "''' + str(network[0]) + '''",
-            "value": "''' + str(network[1]) + '''"
-        },
-        '''
-    attachement_end = '''
-                                    ]
-                                }
-                            ]
-                        }
-                    ]
-                }
-            ],
-            "actions": [
-                {
-                    "type": "Action.Submit",
-                    "title": "Submit"
-                }
-            ]
-        }
-    }
-    '''
-    attachment = attachment_start + attachment_insert.rsplit(',', 1)[0] + attachement_end
-    backupmessage = "This is an example using Adaptive Cards."
-
-    c = create_message_with_attachment(roomId,
-                                       msgtxt=backupmessage,
-                                       attachment=json.loads(attachment))
-    print(c)
-    return ""
+    total, rows = network_index.search("", limit=network_card_max_choices)
+    if total > network_card_max_choices:
+        # Too many networks for one choice list: ask for a search instead
+        return show_network_search_card(roomId)
+    if total:
+        networks = network_choices(rows)
+    else:
+        # The index hasn't been filled yet
+        networks = cached_meraki_org_networks()
+    attachment = cards.NETWORKS_CARD.dumps(choices=cards.choices(networks), windows=traffic_windows())
+    return send_card(roomId, attachment)
+
+
+# Choices for network index rows, labelled with their org so same-named
+# networks in different orgs can be told apart
+def network_choices(rows):
+    return [("{} ({})".format(name, org_name) if org_name else name, network_id)
+            for name, network_id, org_name in rows]
+
+
+def traffic_windows():
+    return cards.window_choices(stored=bool(traffic_snapshot_networks))
+
+
+def show_network_search_card(roomId):
+    return send_card(roomId, cards.NETWORK_SEARCH_CARD_JSON)
+
+
+def show_network_results_card(roomId, query, page=0):
+    total, rows = network_index.search(query, limit=network_search_page_size,
+                                       offset=page * network_search_page_size)
+    if total == 0:
+        return "No networks match **{}**.".format(query)
+    first = page * network_search_page_size + 1
+    title = 'Networks matching "{}" ({}-{} of {})'.format(query, first, first + len(rows) - 1, total)
+    choices = network_choices(rows)
+    actions = cards.submit_actions()
+    if page > 0:
+        actions.append(cards.page_action("Previous", query, page - 1))
+    if first + len(rows) - 1 < total:
+        actions.append(cards.page_action("Next", query, page + 1))
+    attachment = cards.NETWORK_RESULTS_CARD.dumps(title=title, choices=cards.choices(choices),
+                                                  windows=traffic_windows(), actions=actions)
+    return send_card(roomId, attachment)
+
+
+# "/network <name>" searches the local network index
+def network_search_command(incoming_msg):
+    """
+    Show networks whose name starts with or contains the given text.
+    :param incoming_msg: The incoming message object from Teams
+    :return: A text or markdown based reply
+    """
+    query = bot.extract_message("/network", incoming_msg.text).strip()
+    if not query:
+        return show_network_search_card(incoming_msg.roomId)
+    return show_network_results_card(incoming_msg.roomId, query)
+
+
+# Windows answered from the traffic store rather than the API: length in
+# seconds and how the card names it
+TRAFFIC_WINDOWS = {"1d": (86400, "last 24 hours"), "7d": (7 * 86400, "last 7 days")}
+
+
+def show_meraki_traffic_card(roomId, network_id, window="live"):
+    if window == "delta_1d":
+        return show_meraki_traffic_delta_card(roomId, network_id, 86400)
+    note = None
+    if window in TRAFFIC_WINDOWS:
+        length, label = TRAFFIC_WINDOWS[window]
+        now = time.time()
+        coverage = traffic_store.coverage(network_id)
+        if coverage is not None and coverage[1] > now - length:
+            return show_stored_traffic_card(roomId, network_id, now, length, label, coverage[0])
+        # Nothing stored for the window: say so rather than passing live
+        # data off as the stored range
+        note = "No stored traffic for the {}, showing live data".format(label)
+    prefetcher.record_request(network_id)
+    ready = prefetcher.ready(network_id)
+    if ready is not None:
+        image_name, generated_at = ready
+        return send_traffic_image_card(roomId, image_name, "Top Network Traffic Destinations",
+                                       live_subtitle(time.time() - generated_at, note))
+    with progressive(roomId, "Fetching traffic for this network..."):
+        image_name = render_network_traffic_chart(network_id)
+        prefetcher.put(network_id, image_name)
+        return send_traffic_image_card(roomId, image_name, "Top Network Traffic Destinations",
+                                       live_subtitle(0, note))
+
+
+def live_subtitle(age, note=None):
+    return describe_age(age) if note is None else "{}. {}".format(note, describe_age(age))
+
+
+def show_stored_traffic_card(roomId, network_id, now, length, label, earliest):
+    with metrics.track("traffic_store_query"):
+        network_traffic_desc = traffic_store.top(network_id, now - length, now,
+                                                 traffic_applications, traffic_top_k)
+    if earliest > now - length:
+        subtitle = "Stored snapshots only cover the last {}".format(describe_span(now - earliest))
+    else:
+        subtitle = "From stored traffic snapshots"
+    return send_network_traffic_card(roomId, network_traffic_desc,
+                                     "Top Network Traffic Destinations, " + label, subtitle)
+
+
+def render_network_traffic_chart(network_id):
+    return generate_network_traffic_chart(get_meraki_network_traffic(network_id))
+
 
+def show_meraki_traffic_delta_card(roomId, network_id, window):
+    coverage = traffic_store.coverage(network_id)
+    if coverage is None:
+        if not traffic_snapshot_networks:
+            return "Traffic history is not being recorded, so there is nothing to compare yet."
+        return "No stored traffic history for that network yet."
+    now = time.time()
+    if coverage[1] <= now - window:
+        return "No stored traffic for that network in the last {}.".format(describe_span(window))
+    if coverage[0] > now - 2 * window:
+        # Without the previous window every destination would show as new
+        return "Comparing with the previous day needs {} of stored traffic, and this network has {}.".format(
+            describe_span(2 * window), describe_span(now - coverage[0]))
+    with metrics.track("traffic_store_query"):
+        rows = traffic_store.delta(network_id, window, applications=traffic_applications, k=traffic_top_k)
+    facts = [{"title": destination,
+              "value": "{:+,.0f} ({:,.0f} vs {:,.0f})".format(current - previous, current, previous)}
+             for destination, current, previous in rows]
+    attachment = cards.TRAFFIC_DELTA_CARD.dumps(title="Biggest Traffic Changes vs the Previous Day", facts=facts)
+    return send_card(roomId, attachment)
 
-# This function generates a basic adaptive card and sends it to the user
-# You can use Microsofts Adaptive Card designer here:
-# https://adaptivecards.io/designer/. The formatting that Webex Teams
-# uses isn't the same, but this still helps with the overall layout
-# make sure to take the data that comes out of the MS card designer and
-# put it inside of the "content" below, otherwise Webex won't understand
-# what you send it.
-def show_meraki_traffic_card(roomId, network_id):
-    network_traffic_desc = get_meraki_network_traffic(network_id)
+
+def show_meraki_org_traffic_card(roomId):
+    with progressive(roomId, "Collecting traffic across every network..."):
+        network_traffic_desc = get_meraki_org_wide_traffic(meraki_org_ids)
+        return send_network_traffic_card(roomId, network_traffic_desc, "Top Org-Wide Traffic Destinations")
+
+
+def send_network_traffic_card(roomId, network_traffic_desc, title, subtitle="Updated just now"):
     image_name = generate_network_traffic_chart(network_traffic_desc)
-    attachment = '''
-    {
-        "contentType": "application/vnd.microsoft.card.adaptive",
-        "content": {
-            "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
-            "type": "AdaptiveCard",
-            "version": "1.0",
-            "body": [
-                {
-                    "type": "ColumnSet",
-                    "columns": [
-                        {
-                            "type": "Column",
-                            "width": 2,
-                            "items": [
-                                {
-                                    "type": "TextBlock",
-                                    "text": "Top Network Traffic Destinations",
-                                    "weight": "Bolder",
-                                    "size": "Medium"
-                                },
-                                {
-                                    "type": "Image",
-                                    "url": "''' + image_upload_url + image_name + '''",
-                                    "size": "auto"
-                                }
-                            ]
-                        }
-                    ]
-                }
-            ]
-        }
-    }
-    '''
-    backupmessage = "This is an example using Adaptive Cards."
-
-    c = create_message_with_attachment(roomId,
-                                       msgtxt=backupmessage,
-                                       attachment=json.loads(attachment))
-    print(c)
-    return ""
+    return send_traffic_image_card(roomId, image_name, title, subtitle)
+
+
+def send_traffic_image_card(roomId, image_name, title, subtitle):
+    attachment = cards.TRAFFIC_CARD.dumps(title=title, subtitle=subtitle, image_url=image_upload_url + image_name)
+    return send_card(roomId, attachment)
 
 
-# This function generates a basic adaptive card and sends it to the user
-# You can use Microsofts Adaptive Card designer here:
-# https://adaptivecards.io/designer/. The formatting that Webex Teams
-# uses isn't the same, but this still helps with the overall layout
-# make sure to take the data that comes out of the MS card designer and
-# put it inside of the "content" below, otherwise Webex won't understand
-# what you send it.
 def show_umbrella_destination_card(roomId):
-    attachment_start = '''
-    {
-        "contentType": "application/vnd.microsoft.card.adaptive",
-        "content": {
-            "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
-            "type": "AdaptiveCard",
-            "version": "1.0",
-            "body": [
-                {
-                    "type": "ColumnSet",
-                    "columns": [
-                        {
-                            "type": "Column",
-                            "width": 2,
-                            "items": [
-                                {
-                                    "type": "TextBlock",
-                                    "text": "Add a Destination to Umbrella",
-                                    "weight": "Bolder",
-                                    "size": "Medium"
-                                },
-                                {
-                                    "type": "TextBlock",
-                                    "text": "Enter a domain to add to an existing destination list.",
-                                    "isSubtle": true,
-                                    "wrap": true
-                                },
-                                {
-                                    "type": "Input.Text",
-                                    "placeholder": "Placeholder text",
-                                    "isVisible": false,
-                                    "id": "card_type",
-                                    "value": "umbrella_destination"
-                                },
-                                {
-                                    "type": "TextBlock",
-                                    "size": "Small",
-                                    "text": "Domain"
-                                },
-                                {
-                                    "type": "Input.Text",
-                                    "id": "domain",
-                                    "placeholder": "example.com"
-                                },
-                                {
-                                    "type": "TextBlock",
-                                    "size": "Small",
-                                    "text": "Destination List"
-                                },
-                                {
-                                    "type": "Input.ChoiceSet",
-                                    "id": "destination_list",
-                                    "placeholder": "Choose a destination list...",
-                                    "choices": [
-    '''
-    attachment_insert = ''''''
-    dest_lists = get_umbrella_destination_lists()
-    for dest_list in dest_lists:
-        attachment_insert += '''
-        {
-            "title": "''' + str(dest_list[0]) + '''",
-            "value": "''' + str(dest_list[1]) + '''"
-        },
-        '''
-    attachement_end = '''
-                                    ]
-                                }
-                            ]
-                        }
-                    ]
-                }
-            ],
-            "actions": [
-                {
-                    "type": "Action.Submit",
-                    "title": "Submit"
-                }
-            ]
-        }
-    }
-    '''
-    attachment = attachment_start + attachment_insert.rsplit(',', 1)[0] + attachement_end
-    backupmessage = "This is an example using Adaptive Cards."
-
-    c = create_message_with_attachment(roomId,
-                                       msgtxt=backupmessage,
-                                       attachment=json.loads(attachment))
-    print(c)
+    dest_lists = cached_umbrella_destination_lists()
+    attachment = cards.UMBRELLA_DESTINATION_CARD.dumps(choices=cards.choices(dest_lists))
+    return send_card(roomId, attachment)
+
+
+def show_umbrella_bulk_card(roomId):
+    dest_lists = cached_umbrella_destination_lists()
+    attachment = cards.UMBRELLA_BULK_CARD.dumps(choices=cards.choices(dest_lists))
+    return send_card(roomId, attachment)
+
+
+# Bulk add from a file: "/umbrella-bulk <destination list name or id>" with
+# a text or CSV file of domains attached to the message
+def umbrella_bulk_command(incoming_msg):
+    """
+    Add every domain in the attached file(s) to a destination list.
+    :param incoming_msg: The incoming message object from Teams
+    :return: A text or markdown based reply
+    """
+    return run_file_command("/umbrella-bulk", incoming_msg, bulk_add_domains)
+
+
+# Sync from a file: "/umbrella-sync <destination list name or id>" adds only
+# the attached domains missing from the list
+def umbrella_sync_command(incoming_msg):
+    """
+    Diff the attached file(s) against a destination list and add what's
+    missing.
+    :param incoming_msg: The incoming message object from Teams
+    :return: A text or markdown based reply
+    """
+    return run_file_command("/umbrella-sync", incoming_msg, sync_domains)
+
+
+def run_file_command(command, incoming_msg, fn):
+    list_ref = bot.extract_message(command, incoming_msg.text).strip()
+    destination_list = None
+    for name, list_id in cached_umbrella_destination_lists():
+        if list_ref in (name, str(list_id)):
+            destination_list = list_id
+    if destination_list is None:
+        return "Usage: **{}** *destination list name or id*, with a file of domains attached.".format(command)
+    if not incoming_msg.files:
+        return "Attach a text or CSV file of domains to the message."
+    return run_once("message:" + incoming_msg.id, incoming_msg.roomId, lambda: schedule(
+        incoming_msg.roomId, incoming_msg.personId, "heavy", apply_to_files, incoming_msg.roomId, fn,
+        list(incoming_msg.files), destination_list))
+
+
+def apply_to_files(roomId, fn, file_urls, destination_list):
+    with progressive(roomId, "Reading the attached domains...") as placeholder:
+        text = "\n".join(clients.webex().get(url).text for url in file_urls)
+        return placeholder.reply(fn(text, destination_list))
+
+
+# Tell the user an upstream is degraded instead of leaving them waiting
+def show_upstream_unavailable_card(roomId, error):
+    text = "{} is busy or unavailable right now, please try again in a minute.".format(error.upstream)
+    if error.upstream == "Webex":
+        # Can't post a card through the upstream that is failing
+        return text
+    return send_card(roomId, cards.NOTICE_CARD.dumps(title="Service Unavailable", text=text), msgtxt=text)
+
+
+# Webhook entry point for card actions. The action has to be fetched so
+# the scheduler knows what it costs: inline that happens here, in a worker
+# execution mode it happens on a card fetcher so Webex gets its 200 right
+# away.
+def handle_cards(api, incoming_msg):
+    """
+    Admit a card action and run it inline or hand it to the worker pool.
+    :param api: webexteamssdk object
+    :param incoming_msg: The incoming message object from Teams
+    :return: A text or markdown based reply
+    """
+    def admit():
+        m = get_attachment_actions(incoming_msg["data"]["id"])
+        return schedule(incoming_msg["data"]["roomId"], incoming_msg["data"]["personId"], operation_class(m),
+                        process_card_action, incoming_msg, m)
+
+    def start():
+        if card_fetchers is None:
+            return admit()
+        result = Future()
+
+        def fetch_and_admit():
+            try:
+                future = admit()
+            except Exception as e:
+                result.set_exception(e)
+                return
+            future.add_done_callback(lambda f: chain(f, result))
+        if card_fetchers.submit(fetch_and_admit) is None:
+            raise Busy("queue")
+        return result
+    return run_once("action:" + incoming_msg["data"]["id"], incoming_msg["data"]["roomId"], start)
+
+
+def chain(source, target):
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+# Webex redelivers a webhook when we are slow to answer it: start handling
+# an event only once, and forget it again if starting or the work failed
+# so a later redelivery can retry. A request turned away after the webhook
+# has returned gets its busy reply posted to the room.
+def run_once(event_key, roomId, start):
+    """
+    :param event_key: Key of the webhook event
+    :param roomId: Room the event came from
+    :param start: Callable that starts the work and returns a Future of it
+    :return: A text or markdown based reply
+    """
+    if not idempotency.claim(event_key):
+        return ""
+    try:
+        future = start()
+    except Busy as e:
+        idempotency.finish(event_key, error=e)
+        return busy_reply(e)
+    except UpstreamUnavailable as e:
+        idempotency.finish(event_key, error=e)
+        return show_upstream_unavailable_card(roomId, e)
+    except Exception as e:
+        idempotency.finish(event_key, error=e)
+        raise
+
+    def finished(f):
+        error = f.exception()
+        idempotency.finish(event_key, error=error)
+        if isinstance(error, Busy):
+            create_message(roomId, busy_reply(error))
+        elif isinstance(error, UpstreamUnavailable):
+            reply = show_upstream_unavailable_card(roomId, error)
+            if reply:
+                create_message(roomId, reply)
+    future.add_done_callback(finished)
     return ""
 
 
+# Cost class of a card action: charts, org-wide collection and bulk adds
+# are heavy, so single adds, searches and card navigation overtake them
+def operation_class(m):
+    inputs = m.get("inputs", {})
+    card_type = inputs.get("card_type")
+    if card_type == "umbrella_bulk":
+        return "heavy"
+    if card_type == "choose_operation" and inputs.get("operation") == "meraki_org_traffic":
+        return "heavy"
+    if card_type == "meraki_choose_network" and "search_page" not in inputs:
+        return "heavy"
+    return "light"
+
+
+def schedule(roomId, personId, cost_class, fn, *args, inline=False):
+    """
+    Admit fn(*args) for a room and user, run it when the scheduler gives it
+    a slot and post its reply. Inline (or with inline=True) the calling
+    thread waits for its turn; in a worker execution mode the slot is
+    taken on the pool.
+    :return: A Future of the run
+    :raises Busy: If a limit was reached
+    """
+    if workers is not None and not inline:
+        return scheduler.submit(workers.submit, roomId, personId, cost_class, run_and_reply, roomId, fn, *args)
+    future = Future()
+    future.set_result(scheduler.run(roomId, personId, cost_class, run_and_reply, roomId, fn, *args))
+    return future
+
+
+BUSY_REPLIES = {
+    "room": "I'm still working on earlier requests in this room, please try again when they're done.",
+    "user": "You already have requests running, please try again when they're done."
+}
+
+
+def busy_reply(error):
+    return BUSY_REPLIES.get(error.reason, "I'm busy right now, please try again in a moment.")
+
+
+# Message commands are quick and take a slot in the webhook thread, so a
+# room can't flood the bot with them
+def scheduled(fn):
+    @functools.wraps(fn)
+    def command(incoming_msg):
+        return run_once("message:" + incoming_msg.id, incoming_msg.roomId, lambda: schedule(
+            incoming_msg.roomId, incoming_msg.personId, "light", fn, incoming_msg, inline=True))
+    return command
+
+
+# Runs once the scheduler admits the request, possibly on a worker: post
+# any text reply ourselves, since the webhook request may have returned.
+def run_and_reply(roomId, fn, *args):
+    with rooms.hold(roomId):
+        reply = fn(*args)
+        if reply:
+            create_message(roomId, reply)
+
+
+def process_card_action(incoming_msg, m):
+    """
+    Handle a card action once per submission, so a double-clicked Submit
+    reuses the first execution instead of repeating it.
+    :param incoming_msg: The incoming message object from Teams
+    :param m: The attachment action details
+    :return: A text or markdown based reply
+    """
+    with trace_log.request(incoming_msg["data"]["id"]):
+        token = metrics.card_type.set(m["inputs"].get("card_type", "unknown"))
+        try:
+            with metrics.track("card_action"):
+                reply, duplicate = idempotency.run(submission_key(m), dispatch_card_action, incoming_msg, m)
+        except UpstreamUnavailable as e:
+            return show_upstream_unavailable_card(incoming_msg["data"]["roomId"], e)
+        finally:
+            metrics.card_type.reset(token)
+    return "" if duplicate else reply
+
+
+def submission_key(m):
+    # Same person submitting the same inputs on the same card message
+    inputs = json.dumps(m.get("inputs", {}), sort_keys=True)
+    data = "{}|{}|{}".format(m.get("messageId"), m.get("personId"), inputs)
+    return "submission:" + hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
 # An example of how to process card actions
-def handle_cards(api, incoming_msg):
+def dispatch_card_action(incoming_msg, m):
     """
     Sample function to handle card actions.
-    :param api: webexteamssdk object
     :param incoming_msg: The incoming message object from Teams
+    :param m: The attachment action details
     :return: A text or markdown based reply
     """
-    m = get_attachment_actions(incoming_msg["data"]["id"])
     card_type = m["inputs"]["card_type"]
     if card_type == "choose_operation":
         selected_operation = m["inputs"]["operation"]
         if selected_operation == "umbrella_destination":
             show_umbrella_destination_card(incoming_msg["data"]["roomId"])
+        elif selected_operation == "umbrella_bulk":
+            show_umbrella_bulk_card(incoming_msg["data"]["roomId"])
         elif selected_operation == "meraki_network_traffic":
             show_meraki_networks_card(incoming_msg["data"]["roomId"])
+        elif selected_operation == "meraki_org_traffic":
+            show_meraki_org_traffic_card(incoming_msg["data"]["roomId"])
     elif card_type == "umbrella_destination":
         domain = m["inputs"]["domain"]
         destination_list = m["inputs"]["destination_list"]
+        load_destination_index(destination_list)
+        if destination_index.contains(destination_list, domain):
+            return "{} is already on that destination list.".format(domain)
         status_code = add_domain_to_destination_list(domain, destination_list)
         if status_code == 200:
             return "Destination added successfully!"
         else:
+            forget_result()
             return "Error occurred during destination submission."
+    elif card_type == "umbrella_bulk":
+        with progressive(incoming_msg["data"]["roomId"], "Adding destinations...") as placeholder:
+            return placeholder.reply(bulk_add_domains(m["inputs"]["domains"], m["inputs"]["destination_list"]))
+    elif card_type == "network_search":
+        return show_network_results_card(incoming_msg["data"]["roomId"], m["inputs"].get("query", ""))
     elif card_type == "meraki_choose_network":
+        if "search_page" in m["inputs"]:
+            return show_network_results_card(incoming_msg["data"]["roomId"], m["inputs"]["search_query"],
+                                             int(m["inputs"]["search_page"]))
         network_id = m["inputs"]["network_id"]
-        show_meraki_traffic_card(incoming_msg["data"]["roomId"], network_id)
+        return show_meraki_traffic_card(incoming_msg["data"]["roomId"], network_id, m["inputs"].get("window", "live"))
+
+
+# Post a card; msgtxt is shown by clients that can't render cards
+def send_card(roomId, attachment, msgtxt="This is an example using Adaptive Cards."):
+    create_message_with_attachment(roomId, msgtxt=msgtxt, attachment=attachment)
+    return ""
 
 
 # Temporary function to send a message with a card attachment (not yet
 # supported by webexteamssdk, but there are open PRs to add this
-# functionality)
+# functionality). The attachment may be a dict or an already serialized
+# JSON string, which is spliced into the body as-is.
+@metrics.timed("webex_create_message_with_attachment")
 def create_message_with_attachment(rid, msgtxt, attachment):
-    headers = {
-        'content-type': 'application/json; charset=utf-8',
-        'authorization': 'Bearer ' + teams_token
-    }
-
-    url = 'https://api.ciscospark.com/v1/messages'
-    data = {"roomId": rid, "attachments": [attachment], "markdown": msgtxt}
-    response = requests.post(url, json=data, headers=headers)
+    url = webex_api_url + '/messages'
+    if isinstance(attachment, str):
+        data = '{{"roomId":{},"attachments":[{}],"markdown":{}}}'.format(
+            json.dumps(rid), attachment, json.dumps(msgtxt))
+        response = clients.webex().post(url, data=data.encode("utf-8"))
+    else:
+        data = {"roomId": rid, "attachments": [attachment], "markdown": msgtxt}
+        response = clients.webex().post(url, json=data)
+    if not response.ok:
+        # Webex explains a rejected card (e.g. one that is too large) in the body
+        sys.stderr.write("Webex rejected a card: {} {}\n".format(response.status_code, response.text))
+    response.raise_for_status()
+    return response.json()
+
+
+@metrics.timed("webex_create_message")
+def create_message(rid, msgtxt):
+    url = webex_api_url + '/messages'
+    data = {"roomId": rid, "markdown": msgtxt}
+    response = clients.webex().post(url, json=data)
     return response.json()
 
 
+@metrics.timed("webex_edit_message")
+def edit_message(message_id, rid, msgtxt):
+    url = webex_api_url + '/messages/' + message_id
+    data = {"roomId": rid, "markdown": msgtxt}
+    response = clients.webex().put(url, json=data)
+    response.raise_for_status()
+    return response.json()
+
+
+@metrics.timed("webex_delete_message")
+def delete_message(message_id):
+    url = webex_api_url + '/messages/' + message_id
+    clients.webex().delete(url).raise_for_status()
+
+
+def post_placeholder(rid, msgtxt):
+    return create_message(rid, msgtxt)["id"]
+
+
+# Placeholder for a slow operation in roomId, edited with progress.report()
+# and replaced by the result; a no-op when progressive replies are disabled.
+# The placeholder is a plain message because Webex can only edit the text
+# of a message, not its card.
+def progressive(roomId, text):
+    return Progress(post_placeholder, edit_message, delete_message, roomId, "_{}_".format(text),
+                    min_interval=progress_update_interval, enabled=progressive_replies)
+
+
 # Temporary function to get card attachment actions (not yet supported
 # by webexteamssdk, but there are open PRs to add this functionality)
+@metrics.timed("webex_get_attachment_actions")
 def get_attachment_actions(attachmentid):
-    headers = {
-        'content-type': 'application/json; charset=utf-8',
-        'authorization': 'Bearer ' + teams_token
-    }
-
-    url = 'https://api.ciscospark.com/v1/attachment/actions/' + attachmentid
-    response = requests.get(url, headers=headers)
+    url = webex_api_url + '/attachment/actions/' + attachmentid
+    response = clients.webex().get(url)
     return response.json()
 
 
+# Serves chart images from the shared backend, for deployments where
+# IMAGE_UPLOAD_URL points at the bot's /media/ path
+def media_endpoint(name):
+    data = shared.get_blob(name)
+    if data is None:
+        return "Not found", 404
+    # Names are content hashes, so an image never changes
+    return data, 200, {"Content-Type": "image/png", "Cache-Control": "public, max-age=86400"}
+
+
+# Prometheus scrape endpoint for stage latencies, errors and in-flight work;
+# with a shared backend it reports the sum over every worker process
+def metrics_endpoint():
+    text = shared_metrics.render() if shared_metrics is not None else metrics.REGISTRY.render()
+    return text, 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
 # An example using a Response object.  Response objects allow more complex
 # replies including sending files, html, markdown, or text. Rsponse objects
 # can also set a roomId to send response to a different room from where
@@ -477,6 +1062,8 @@ def ret_message(incoming_msg):
     :param incoming_msg: The incoming message object from Teams
     :return: A Response object based reply
     """
+    from webexteamsbot.models import Response
+
     # Create a object to create a reply.
     response = Response()
 
@@ -490,17 +1077,135 @@ def ret_message(incoming_msg):
     return response
 
 
-# Set the bot greeting.
-bot.set_greeting(greeting)
+# Capture traffic snapshots for the configured networks in the background
+def capture_network_traffic(network_id, timespan):
+    with metrics.track("meraki_get_network_traffic"):
+        return clients.meraki().networks.getNetworkTraffic(network_id, timespan=timespan)
 
-# Add new commands to the bot.
-bot.add_command('attachmentActions', '*', handle_cards)
-bot.add_command("/operations", "Show Cloud Operations", show_operations_card)
 
-# Every bot includes a default "/echo" command.  You can remove it, or any
-# other command with the remove_command(command) method.
-bot.remove_command("/echo")
+def snapshot_network_ids():
+    if traffic_snapshot_networks == "*":
+        return network_index.network_ids()
+    return [n for n in traffic_snapshot_networks.split(",") if n]
+
+
+# Keep the network index up to date in the background
+network_index_refresher = NetworkIndexRefresher(
+    network_index, list_meraki_orgs, list_meraki_networks, interval=network_index_refresh)
+
+traffic_snapshotter = TrafficSnapshotter(
+    traffic_store, capture_network_traffic, snapshot_network_ids,
+    interval=traffic_snapshot_interval, max_workers=traffic_snapshot_workers,
+    retention=traffic_retention_days * 86400)
+
+# Keep charts warm for allowlisted and frequently requested networks
+prefetcher = ChartPrefetcher(
+    render_network_traffic_chart, interval=prefetch_interval or 600,
+    allowlist=prefetch_networks, top_n=prefetch_top_n, jitter=prefetch_jitter,
+    max_workers=prefetch_workers, is_available=charts.contains, store=shared)
+
+
+def start_background_tasks():
+    if network_index_refresh > 0:
+        network_index_refresher.start()
+    if traffic_snapshot_networks:
+        traffic_snapshotter.start()
+    if prefetch_interval > 0:
+        prefetcher.start()
+
+
+def stop_background_tasks():
+    network_index_refresher.stop()
+    traffic_snapshotter.stop()
+    prefetcher.stop()
+
+
+def warm_up():
+    """
+    Pay first-use costs before serving: load numpy, start the chart render
+    processes and fill the networks and destination list caches.
+    """
+    import numpy  # noqa: F401
+
+    for step in (charts.warm_up, clients.webex, cached_meraki_org_networks, cached_umbrella_destination_lists):
+        try:
+            step()
+        except Exception as e:
+            sys.stderr.write("Warm-up step {} failed: {}\n".format(step.__name__, e))
+
+
+def create_app(webhooks=True, warm=False, background=True, elect=False):
+    """
+    Build the bot, without side effects unless asked for.
+    :param webhooks: Create or update the Webex webhooks
+    :param warm: Run warm_up() before returning
+    :param background: Start the index, snapshot and prefetch threads
+    :param elect: With a shared backend, only register webhooks and run
+            background threads in the worker elected leader
+    :return: The bot, a Flask application
+    """
+    global bot
+    from deferred_bot import DeferredTeamsBot
+
+    # Create a Bot Object
+    bot = DeferredTeamsBot(
+        bot_app_name,
+        teams_bot_token=teams_token,
+        teams_api_url=webex_api_url + "/",
+        teams_bot_url=bot_url,
+        teams_bot_email=bot_email,
+        webhook_resource_event=[{"resource": "messages", "event": "created"},
+                                {"resource": "attachmentActions", "event": "created"}]
+    )
+
+    # Set the bot greeting.
+    bot.set_greeting(greeting)
+
+    # Add new commands to the bot.
+    bot.add_command('attachmentActions', '*', handle_cards)
+    bot.add_command("/operations", "Show Cloud Operations", scheduled(show_operations_card))
+    bot.add_command("/network", "Search Meraki networks by name", scheduled(network_search_command))
+    bot.add_command("/umbrella-bulk", "Add the domains in an attached file to a destination list", umbrella_bulk_command)
+    bot.add_command("/umbrella-sync", "Add the domains in an attached file that are missing from a destination list", umbrella_sync_command)
+    bot.add_command("/refresh", "Reload cached networks and destination lists", scheduled(refresh_caches))
+
+    # Expose metrics on the bot's Flask app
+    bot.add_url_rule("/metrics", "metrics", metrics_endpoint)
+    if shared is not None:
+        bot.add_url_rule("/media/<name>", "media", media_endpoint)
+        if "blob_path" not in shared_backend_options and not (image_upload_url or "").rstrip("/").endswith("/media"):
+            sys.stderr.write("WARNING: chart images are stored in the shared backend, not MEDIA_PATH; "
+                             "point IMAGE_UPLOAD_URL at this bot's /media/ path or traffic cards "
+                             "will show broken images\n")
+
+    # Every bot includes a default "/echo" command.  You can remove it, or any
+    # other command with the remove_command(command) method.
+    bot.remove_command("/echo")
+
+    if shared_metrics is not None:
+        shared_metrics.start()
+
+    if warm:
+        warm_up()
+    if elect and shared is not None:
+        LeaderLease(shared, "leader", ttl=leader_ttl,
+                    on_elected=lambda: lead(webhooks, background),
+                    on_lost=stop_background_tasks).start()
+    else:
+        lead(webhooks, background)
+    return bot
+
+
+def lead(webhooks, background):
+    if webhooks:
+        bot.register_webhooks()
+    if background:
+        start_background_tasks()
+
 
 if __name__ == "__main__":
-    # Run Bot
-    bot.run(host="0.0.0.0", port=5000)
\ No newline at end of file
+    # Exit cleanly on SIGTERM so the worker pool drains queued card actions
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # Run Bot on Flask's development server; see server.py for production
+    create_app(webhooks=register_webhooks, warm=warm_up_on_start).run(host="0.0.0.0", port=bot_port)
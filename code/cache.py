@@ -0,0 +1,171 @@
+from collections import OrderedDict
+import sys
+import threading
+import time
+
+
+class _Entry(object):
+    __slots__ = ("value", "fresh_until", "stale_until")
+
+    def __init__(self, value, fresh_until, stale_until):
+        self.value = value
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+
+
+class TTLCache(object):
+    """
+    Size-bounded, thread-safe cache with per-key TTLs and
+    stale-while-revalidate semantics.
+
+    Fresh entries are returned as-is. Entries past their TTL but still
+    within their stale window are returned immediately while a background
+    thread reloads them. Only a missing (or fully expired) entry makes the
+    caller wait on the loader, and concurrent misses for the same key share
+    a single load.
+
+    With a shared backend, loaded values are also written there (as JSON)
+    and a local miss is served from it before calling the loader, so
+    every worker process sees one copy.
+    """
+
+    def __init__(self, max_entries=256, backend=None, namespace="cache:"):
+        """
+        :param max_entries: Maximum number of keys kept before the least
+                recently used one is evicted
+        :param backend: Optional SharedBackend shared by all workers
+        :param namespace: Prefix of this cache's keys in the backend
+        """
+        self.max_entries = max_entries
+        self.backend = backend
+        self.namespace = namespace
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._refreshing = set()
+
+    def get(self, key, loader, ttl, stale_ttl=0):
+        """
+        Return the cached value for key, loading it if needed.
+        :param key: Cache key
+        :param loader: Zero-argument callable producing the value
+        :param ttl: Seconds the value is considered fresh
+        :param stale_ttl: Extra seconds a stale value may still be served
+                while it is refreshed in the background
+        :return: The cached or freshly loaded value
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if now < entry.fresh_until:
+                    return entry.value
+                if now < entry.stale_until:
+                    self._start_refresh(key, loader, ttl, stale_ttl)
+                    return entry.value
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # Miss: load synchronously, but only once per key
+        with key_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and time.monotonic() < entry.fresh_until:
+                    return entry.value
+            shared = self._get_shared(key)
+            if shared is not None:
+                value, fresh_for = shared
+                self._set_local(key, value, fresh_for, stale_ttl)
+                if fresh_for <= 0:
+                    self.refresh(key, loader, ttl, stale_ttl)
+                return value
+            value = loader()
+            self.set(key, value, ttl, stale_ttl)
+            return value
+
+    def set(self, key, value, ttl, stale_ttl=0):
+        self._set_local(key, value, ttl, stale_ttl)
+        if self.backend is not None:
+            self.backend.set(self.namespace + key,
+                             {"value": value, "fresh_until": time.time() + ttl}, ttl + stale_ttl)
+
+    def _get_shared(self, key):
+        """
+        :return: (value, seconds it stays fresh) from the backend, or None
+        """
+        if self.backend is None:
+            return None
+        shared = self.backend.get(self.namespace + key)
+        if shared is None:
+            return None
+        return shared["value"], shared["fresh_until"] - time.time()
+
+    def _set_local(self, key, value, ttl, stale_ttl):
+        now = time.monotonic()
+        with self._lock:
+            self._entries[key] = _Entry(value, now + ttl, now + ttl + stale_ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                self._key_locks.pop(evicted, None)
+
+    def peek(self, key):
+        """
+        Return the cached value for key without loading or refreshing it.
+        :return: The value, or None if the key is not cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry.value if entry is not None else None
+
+    def invalidate(self, key=None):
+        """
+        Drop a single key, or every key when key is None.
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+        if self.backend is not None:
+            if key is None:
+                self.backend.delete_prefix(self.namespace)
+            else:
+                self.backend.delete(self.namespace + key)
+
+    def refresh(self, key, loader, ttl, stale_ttl=0):
+        """
+        Reload key in the background, keeping any current value servable.
+        """
+        with self._lock:
+            self._start_refresh(key, loader, ttl, stale_ttl)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    # Must be called with self._lock held
+    def _start_refresh(self, key, loader, ttl, stale_ttl):
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+        thread = threading.Thread(
+            target=self._refresh, args=(key, loader, ttl, stale_ttl),
+            name="cache-refresh", daemon=True
+        )
+        thread.start()
+
+    def _refresh(self, key, loader, ttl, stale_ttl):
+        try:
+            # Another worker may already have refreshed the shared copy
+            shared = self._get_shared(key)
+            if shared is not None and shared[1] > 0:
+                self._set_local(key, shared[0], shared[1], stale_ttl)
+            else:
+                self.set(key, loader(), ttl, stale_ttl)
+        except Exception as e:
+            # Keep serving the stale value; the next read retries
+            sys.stderr.write("Cache refresh of {} failed: {}\n".format(key, e))
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
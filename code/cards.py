@@ -0,0 +1,427 @@
+# Adaptive Card skeletons, built once at import as native structures.
+#
+# You can use Microsofts Adaptive Card designer here:
+# https://adaptivecards.io/designer/. The formatting that Webex Teams
+# uses isn't the same, but this still helps with the overall layout
+# make sure to take the data that comes out of the MS card designer and
+# put it inside of the "content" below, otherwise Webex won't understand
+# what you send it.
+import json
+
+
+def _card(items, actions=None):
+    content = {
+        "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
+        "type": "AdaptiveCard",
+        "version": "1.0",
+        "body": [
+            {
+                "type": "ColumnSet",
+                "columns": [
+                    {
+                        "type": "Column",
+                        "width": 2,
+                        "items": items
+                    }
+                ]
+            }
+        ]
+    }
+    if actions is not None:
+        content["actions"] = actions
+    return {
+        "contentType": "application/vnd.microsoft.card.adaptive",
+        "content": content
+    }
+
+
+def _submit():
+    return [
+        {
+            "type": "Action.Submit",
+            "title": "Submit"
+        }
+    ]
+
+
+def _card_type(value):
+    # Hidden input telling handle_cards which card was submitted
+    return {
+        "type": "Input.Text",
+        "placeholder": "Placeholder text",
+        "isVisible": False,
+        "id": "card_type",
+        "value": value
+    }
+
+
+def choices(pairs):
+    """
+    Turn (title, value) pairs into Input.ChoiceSet choices.
+    """
+    return [{"title": str(title), "value": str(value)} for title, value in pairs]
+
+
+class CardTemplate(object):
+    """
+    A card skeleton with named dynamic slots.
+
+    build() returns a dict that shares every static part with the skeleton
+    and only copies the containers on the path to each slot. dumps()
+    returns the card as JSON by splicing the serialized slot values
+    between fragments of the skeleton serialized once up front, so neither
+    path re-serializes or re-parses the static parts of the card.
+    """
+
+    def __init__(self, card, **slots):
+        """
+        :param card: Card skeleton
+        :param slots: Slot name -> path of keys/indexes to the slot
+        """
+        self.card = card
+        self.slots = slots
+        # Serialize once with unique markers at the slot positions, then
+        # split around them
+        markers = {}
+        marked = card
+        for name, path in slots.items():
+            marker = "\x00slot:{}\x00".format(name)
+            markers[json.dumps(marker)] = name
+            marked = _splice(marked, path, marker)
+        serialized = json.dumps(marked, separators=(",", ":"))
+        self._fragments = []
+        self._order = []
+        while True:
+            positions = [(serialized.find(m), m) for m in markers if m in serialized]
+            if not positions:
+                break
+            index, marker = min(positions)
+            self._fragments.append(serialized[:index])
+            self._order.append(markers[marker])
+            serialized = serialized[index + len(marker):]
+        self._fragments.append(serialized)
+
+    def build(self, **values):
+        card = self.card
+        for name, value in values.items():
+            card = _splice(card, self.slots[name], value)
+        return card
+
+    def dumps(self, **values):
+        parts = [self._fragments[0]]
+        for name, fragment in zip(self._order, self._fragments[1:]):
+            parts.append(json.dumps(values[name], separators=(",", ":")))
+            parts.append(fragment)
+        return "".join(parts)
+
+
+def _splice(node, path, value):
+    # Copy only the containers along path and set value at its end
+    if not path:
+        return value
+    key = path[0]
+    if isinstance(node, list):
+        copy = list(node)
+    else:
+        copy = dict(node)
+    copy[key] = _splice(node[key], path[1:], value)
+    return copy
+
+
+def window_choices(stored=True):
+    """
+    Time ranges for the traffic card; stored ranges are served locally and
+    only offered when traffic snapshots are being recorded.
+    """
+    windows = [{"title": "Last 24 hours (live)", "value": "live"}]
+    if stored:
+        windows += [
+            {"title": "Last 24 hours (stored)", "value": "1d"},
+            {"title": "Last 7 days (stored)", "value": "7d"},
+            {"title": "Change since the previous day", "value": "delta_1d"}
+        ]
+    return windows
+
+
+def _window_choice():
+    return {
+        "type": "Input.ChoiceSet",
+        "id": "window",
+        "value": "live",
+        "choices": window_choices()
+    }
+
+
+def _items_path(index, *rest):
+    return ("content", "body", 0, "columns", 0, "items", index) + rest
+
+
+OPERATIONS_CARD = _card([
+    {
+        "type": "TextBlock",
+        "text": "Choose an Operation",
+        "weight": "Bolder",
+        "size": "Medium"
+    },
+    _card_type("choose_operation"),
+    {
+        "type": "TextBlock",
+        "text": "Select an operation to perform across your Cisco cloud-based products.",
+        "isSubtle": True,
+        "wrap": True
+    },
+    {
+        "type": "Input.ChoiceSet",
+        "id": "operation",
+        "placeholder": "Choose an operation...",
+        "choices": [
+            {
+                "title": "View Meraki Traffic",
+                "value": "meraki_network_traffic"
+            },
+            {
+                "title": "View Org-Wide Meraki Traffic",
+                "value": "meraki_org_traffic"
+            },
+            {
+                "title": "Add Umbrella Domain Policy",
+                "value": "umbrella_destination"
+            },
+            {
+                "title": "Bulk Add Umbrella Domains",
+                "value": "umbrella_bulk"
+            }
+        ]
+    }
+], _submit())
+
+# The operations card never changes, so it is kept pre-serialized
+OPERATIONS_CARD_JSON = json.dumps(OPERATIONS_CARD, separators=(",", ":"))
+
+NETWORKS_CARD = CardTemplate(
+    _card([
+        {
+            "type": "TextBlock",
+            "text": "Choose a Network",
+            "weight": "Bolder",
+            "size": "Medium"
+        },
+        _card_type("meraki_choose_network"),
+        {
+            "type": "TextBlock",
+            "size": "Small",
+            "text": "Network"
+        },
+        {
+            "type": "Input.ChoiceSet",
+            "id": "network_id",
+            "placeholder": "Choose an organization network...",
+            "choices": []
+        },
+        _window_choice()
+    ], _submit()),
+    choices=_items_path(3, "choices"),
+    windows=_items_path(4, "choices")
+)
+
+TRAFFIC_CARD = CardTemplate(
+    _card([
+        {
+            "type": "TextBlock",
+            "text": "",
+            "weight": "Bolder",
+            "size": "Medium"
+        },
+        {
+            "type": "TextBlock",
+            "text": "",
+            "size": "Small",
+            "isSubtle": True
+        },
+        {
+            "type": "Image",
+            "url": "",
+            "size": "auto"
+        }
+    ]),
+    title=_items_path(0, "text"),
+    subtitle=_items_path(1, "text"),
+    image_url=_items_path(2, "url")
+)
+
+TRAFFIC_DELTA_CARD = CardTemplate(
+    _card([
+        {
+            "type": "TextBlock",
+            "text": "",
+            "weight": "Bolder",
+            "size": "Medium",
+            "wrap": True
+        },
+        {
+            "type": "FactSet",
+            "facts": []
+        }
+    ]),
+    title=_items_path(0, "text"),
+    facts=_items_path(1, "facts")
+)
+
+NOTICE_CARD = CardTemplate(
+    _card([
+        {
+            "type": "TextBlock",
+            "text": "",
+            "weight": "Bolder",
+            "size": "Medium"
+        },
+        {
+            "type": "TextBlock",
+            "text": "",
+            "wrap": True
+        }
+    ]),
+    title=_items_path(0, "text"),
+    text=_items_path(1, "text")
+)
+
+UMBRELLA_DESTINATION_CARD = CardTemplate(
+    _card([
+        {
+            "type": "TextBlock",
+            "text": "Add a Destination to Umbrella",
+            "weight": "Bolder",
+            "size": "Medium"
+        },
+        {
+            "type": "TextBlock",
+            "text": "Enter a domain to add to an existing destination list.",
+            "isSubtle": True,
+            "wrap": True
+        },
+        _card_type("umbrella_destination"),
+        {
+            "type": "TextBlock",
+            "size": "Small",
+            "text": "Domain"
+        },
+        {
+            "type": "Input.Text",
+            "id": "domain",
+            "placeholder": "example.com"
+        },
+        {
+            "type": "TextBlock",
+            "size": "Small",
+            "text": "Destination List"
+        },
+        {
+            "type": "Input.ChoiceSet",
+            "id": "destination_list",
+            "placeholder": "Choose a destination list...",
+            "choices": []
+        }
+    ], _submit()),
+    choices=_items_path(6, "choices")
+)
+
+UMBRELLA_BULK_CARD = CardTemplate(
+    _card([
+        {
+            "type": "TextBlock",
+            "text": "Bulk Add Destinations to Umbrella",
+            "weight": "Bolder",
+            "size": "Medium"
+        },
+        {
+            "type": "TextBlock",
+            "text": "Paste domains one per line or comma separated. To import a file, send **/umbrella-bulk** with the list name and the file attached.",
+            "isSubtle": True,
+            "wrap": True
+        },
+        _card_type("umbrella_bulk"),
+        {
+            "type": "TextBlock",
+            "size": "Small",
+            "text": "Domains"
+        },
+        {
+            "type": "Input.Text",
+            "id": "domains",
+            "isMultiline": True,
+            "placeholder": "example.com\nexample.net"
+        },
+        {
+            "type": "TextBlock",
+            "size": "Small",
+            "text": "Destination List"
+        },
+        {
+            "type": "Input.ChoiceSet",
+            "id": "destination_list",
+            "placeholder": "Choose a destination list...",
+            "choices": []
+        }
+    ], _submit()),
+    choices=_items_path(6, "choices")
+)
+
+# Shown instead of the networks card when there are too many networks to
+# list; answered from the local network index
+NETWORK_SEARCH_CARD_JSON = json.dumps(_card([
+    {
+        "type": "TextBlock",
+        "text": "Find a Network",
+        "weight": "Bolder",
+        "size": "Medium"
+    },
+    _card_type("network_search"),
+    {
+        "type": "TextBlock",
+        "text": "Enter the start or any part of a network name.",
+        "isSubtle": True,
+        "wrap": True
+    },
+    {
+        "type": "Input.Text",
+        "id": "query",
+        "placeholder": "Branch"
+    }
+], _submit()), separators=(",", ":"))
+
+NETWORK_RESULTS_CARD = CardTemplate(
+    _card([
+        {
+            "type": "TextBlock",
+            "text": "",
+            "weight": "Bolder",
+            "size": "Medium",
+            "wrap": True
+        },
+        _card_type("meraki_choose_network"),
+        {
+            "type": "Input.ChoiceSet",
+            "id": "network_id",
+            "placeholder": "Choose a network...",
+            "choices": []
+        },
+        _window_choice()
+    ], []),
+    title=_items_path(0, "text"),
+    choices=_items_path(2, "choices"),
+    windows=_items_path(3, "choices"),
+    actions=("content", "actions")
+)
+
+
+def page_action(title, query, page):
+    # Submit that asks for another page of search results
+    return {
+        "type": "Action.Submit",
+        "title": title,
+        "data": {"search_query": query, "search_page": page}
+    }
+
+
+def submit_actions():
+    return _submit()
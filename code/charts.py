@@ -0,0 +1,189 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+import hashlib
+import io
+import json
+import os
+import sys
+import threading
+
+
+def render_traffic_chart(labels, values):
+    """
+    Render a pie chart of top destinations on its own Figure, so renders
+    don't share pyplot state and nothing is left open afterwards.
+    :param labels: Destination names
+    :param values: Totals aligned with labels
+    :return: PNG bytes
+    """
+    # matplotlib is imported on first use (in the render process) to keep
+    # bot startup fast
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    patches, texts = ax.pie(values, startangle=90)
+    ax.legend(patches, labels, bbox_to_anchor=(1, 0.5), loc="center right", fontsize=10, bbox_transform=fig.transFigure)
+    fig.subplots_adjust(left=0.0, bottom=0.1, right=0.55)
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png")
+    return buf.getvalue()
+
+
+def load_renderer():
+    """
+    Import matplotlib ahead of the first render.
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg  # noqa: F401
+    from matplotlib.figure import Figure  # noqa: F401
+
+
+def chart_key(top_dests):
+    """
+    Content hash of the charted data, used as the image name.
+    """
+    data = json.dumps([[str(d), float(v)] for d, v in top_dests], separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:32]
+
+
+class ChartCache(object):
+    """
+    Content-addressed cache of rendered traffic charts.
+
+    Images are named after a hash of the data they show and written under
+    media_path, so identical data is never rendered twice and concurrent
+    requests for different data never overwrite each other. Rendering runs
+    in a process pool; at most max_entries images are kept on disk, the
+    least recently used being deleted first.
+
+    With a shared store, images are written there as blobs instead (the
+    SQLite backend keeps them under media_path), and an image another
+    worker already rendered is reused.
+    """
+
+    def __init__(self, media_path, max_entries=64, render_workers=2, store=None):
+        """
+        :param media_path: Directory served at IMAGE_UPLOAD_URL
+        :param max_entries: Maximum number of chart images kept
+        :param render_workers: Processes used for rendering
+        :param store: Optional SharedBackend holding the images
+        """
+        self.media_path = media_path or ""
+        self.store = store
+        self.max_entries = max_entries
+        self.render_workers = render_workers
+        self._executor = None
+        self._pid = None
+        self._images = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        # A forked worker process can't use its parent's render processes
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ProcessPoolExecutor(max_workers=self.render_workers)
+            self._pid = os.getpid()
+        return self._executor
+
+    def image_name(self, top_dests):
+        """
+        Return the image name for top_dests, rendering it if needed.
+        :param top_dests: List of (destination, total) to chart
+        :return: File name relative to media_path
+        """
+        key = chart_key(top_dests)
+        name = "traffic-{}.png".format(key)
+        with self._lock:
+            cached = key in self._images
+            if cached:
+                self._images.move_to_end(key)
+        # A shared store may have been pruned by another worker
+        if cached and (self.store is None or self.store.has_blob(name)):
+            return name
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+        if not owner:
+            future.result()
+            return name
+
+        if self.store is not None and self.store.has_blob(name):
+            # Rendered by another worker
+            with self._lock:
+                self._images[key] = name
+                self._inflight.pop(key, None)
+            future.set_result(name)
+            return name
+
+        try:
+            labels = [dest[0] for dest in top_dests]
+            values = [dest[1] for dest in top_dests]
+            png = self._pool().submit(render_traffic_chart, labels, values).result()
+            self._write(name, png)
+            with self._lock:
+                self._images[key] = name
+                evicted = self._evict()
+            for old in evicted:
+                self._remove(old)
+            future.set_result(name)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+        return name
+
+    def contains(self, name):
+        """
+        :return: True if the named image is still cached on disk
+        """
+        if self.store is not None:
+            return self.store.has_blob(name)
+        with self._lock:
+            return name in self._images.values()
+
+    def warm_up(self):
+        """
+        Start the render processes and load matplotlib in them.
+        """
+        futures = [self._pool().submit(load_renderer) for _ in range(self.render_workers)]
+        for future in futures:
+            future.result()
+
+    def shutdown(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=True)
+
+    # Must be called with self._lock held
+    def _evict(self):
+        evicted = []
+        while len(self._images) > self.max_entries:
+            _, old = self._images.popitem(last=False)
+            evicted.append(old)
+        return evicted
+
+    def _write(self, name, png):
+        if self.store is not None:
+            self.store.put_blob(name, png)
+            return
+        # Write then rename so the image server never sees a partial file
+        path = os.path.join(self.media_path, name)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(png)
+        os.replace(tmp, path)
+
+    def _remove(self, name):
+        if self.store is not None:
+            self.store.delete_blob(name)
+            return
+        try:
+            os.remove(os.path.join(self.media_path, name))
+        except OSError as e:
+            sys.stderr.write("Could not remove chart {}: {}\n".format(name, e))
@@ -0,0 +1,275 @@
+import random
+import re
+import sys
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from ratelimit import CircuitBreaker, KeyedLimiter, TokenBucket, UpstreamUnavailable, backoff, retry_after
+
+_MERAKI_ORG = re.compile(r"/organizations/([^/?]+)")
+_MERAKI_NETWORK = re.compile(r"/networks/([^/?]+)")
+
+# Methods safe to send again after a timeout or 5xx
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS", "PUT", "DELETE"))
+
+
+def _not_sent(error):
+    # Connecting failed, so the upstream never saw the request
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    cause = error.args[0] if error.args else None
+    return isinstance(getattr(cause, "reason", cause), NewConnectionError)
+
+
+class UpstreamPolicy(object):
+    """
+    Rate limit, retry and circuit breaker settings for one upstream.
+    """
+
+    def __init__(self, rate=10, burst=None, max_retries=3, failure_threshold=5, reset_timeout=30):
+        """
+        :param rate: Requests per second allowed by the token bucket
+        :param burst: Bucket capacity, defaults to rate
+        :param max_retries: Retries on 429, and for idempotent methods on
+                5xx and connection errors
+        :param failure_threshold: Consecutive failures that open the breaker
+        :param reset_timeout: Seconds the breaker stays open
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+
+class TimeoutSession(requests.Session):
+    """
+    requests.Session that applies a default timeout to every request.
+    """
+
+    def __init__(self, timeout):
+        super(TimeoutSession, self).__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super(TimeoutSession, self).request(method, url, **kwargs)
+
+
+class UpstreamSession(TimeoutSession):
+    """
+    Session that waits on the upstream's token bucket (and an optional
+    per-key bucket, e.g. per Meraki org) before each request, retries 429s
+    honouring Retry-After plus jitter, retries 5xx and connection errors
+    with jittered backoff, and fails fast while the circuit breaker is
+    open.
+
+    A POST or PATCH may already have taken effect when it times out or
+    gets a 5xx, so those are only retried on 429 or when the connection
+    could not be made.
+    """
+
+    def __init__(self, name, timeout, policy, key_limiter=None, limiter_key=None):
+        super(UpstreamSession, self).__init__(timeout)
+        self.name = name
+        self.policy = policy
+        self.limiter = TokenBucket(policy.rate, policy.burst)
+        self.breaker = CircuitBreaker(name, policy.failure_threshold, policy.reset_timeout)
+        self.key_limiter = key_limiter
+        self.limiter_key = limiter_key
+
+    def request(self, method, url, **kwargs):
+        trial = self.breaker.before()
+        try:
+            return self._attempts(method, url, **kwargs)
+        finally:
+            self.breaker.done(trial)
+
+    def _attempts(self, method, url, **kwargs):
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            if self.key_limiter is not None:
+                key = self.limiter_key(url)
+                if key is not None:
+                    self.key_limiter(key).acquire()
+            try:
+                response = super(UpstreamSession, self).request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.policy.max_retries or not (idempotent or _not_sent(e)):
+                    self.breaker.failure()
+                    raise
+                time.sleep(backoff(attempt))
+                attempt += 1
+                continue
+
+            if response.status_code == 429 or response.status_code >= 500:
+                if attempt >= self.policy.max_retries or (response.status_code != 429 and not idempotent):
+                    self.breaker.failure()
+                    if response.status_code == 429:
+                        raise UpstreamUnavailable(self.name, "rate limited")
+                    return response
+                wait = retry_after(response) if response.status_code == 429 else None
+                if wait is None:
+                    wait = backoff(attempt)
+                else:
+                    # Spread out callers that were told the same Retry-After
+                    wait += random.uniform(0, 1)
+                time.sleep(wait)
+                attempt += 1
+                continue
+
+            self.breaker.success()
+            return response
+
+
+def upstream_session(name, pool_size, timeout, policy, key_limiter=None, limiter_key=None):
+    """
+    Build a keep-alive, rate-limited session with a connection pool of the
+    given size.
+    :param name: Upstream name used in errors
+    :param pool_size: Connections kept open per host
+    :param timeout: Default timeout in seconds for each request
+    :param policy: UpstreamPolicy for the upstream
+    :return: An UpstreamSession
+    """
+    session = UpstreamSession(name, timeout, policy, key_limiter, limiter_key)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class ClientPool(object):
+    """
+    Owns the long-lived HTTP sessions for Webex, Umbrella and Meraki so every
+    outbound call reuses pooled, keep-alive connections instead of paying
+    for a new TCP/TLS handshake, and shares one rate limiter and circuit
+    breaker per upstream (plus one bucket per Meraki org) process-wide.
+    """
+
+    def __init__(self, teams_token, meraki_api_key, umbrella_key,
+                 umbrella_secret, pool_size=10, timeout=30, policies=None,
+                 meraki_org_rate=5, meraki_base_url=None):
+        """
+        :param teams_token: Webex bot access token
+        :param meraki_api_key: Meraki Dashboard API key
+        :param umbrella_key: Umbrella management API key
+        :param umbrella_secret: Umbrella management API secret
+        :param pool_size: Connections kept open per upstream
+        :param timeout: Default timeout in seconds for each request
+        :param policies: Dict of upstream name -> UpstreamPolicy
+        :param meraki_org_rate: Requests per second allowed per Meraki org
+        :param meraki_base_url: Dashboard API base URL, defaults to the SDK's
+        """
+        self.teams_token = teams_token
+        self.meraki_api_key = meraki_api_key
+        self.umbrella_key = umbrella_key
+        self.umbrella_secret = umbrella_secret
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.policies = policies or {}
+        self.meraki_base_url = meraki_base_url
+        self.meraki_org_limiter = KeyedLimiter(meraki_org_rate)
+        # Network id -> org id, so network-scoped Meraki calls are charged
+        # to the right org's budget
+        self.network_orgs = {}
+        self._lock = threading.Lock()
+        self._webex = None
+        self._umbrella = None
+        self._meraki = None
+
+    def _policy(self, name):
+        return self.policies.get(name) or UpstreamPolicy()
+
+    def register_networks(self, org_id, network_ids):
+        for network_id in network_ids:
+            self.network_orgs[network_id] = org_id
+
+    def _meraki_org(self, url):
+        match = _MERAKI_ORG.search(url)
+        if match:
+            return match.group(1)
+        match = _MERAKI_NETWORK.search(url)
+        if match:
+            return self.network_orgs.get(match.group(1))
+        return None
+
+    def webex(self):
+        with self._lock:
+            if self._webex is None:
+                session = upstream_session("Webex", self.pool_size, self.timeout, self._policy("webex"))
+                session.headers.update({
+                    'content-type': 'application/json; charset=utf-8',
+                    'authorization': 'Bearer ' + self.teams_token
+                })
+                self._webex = session
+            return self._webex
+
+    def umbrella(self):
+        with self._lock:
+            if self._umbrella is None:
+                session = upstream_session("Umbrella", self.pool_size, self.timeout, self._policy("umbrella"))
+                session.auth = requests.auth.HTTPBasicAuth(
+                    self.umbrella_key, self.umbrella_secret)
+                self._umbrella = session
+            return self._umbrella
+
+    def meraki(self):
+        with self._lock:
+            if self._meraki is None:
+                # The SDK is imported on first use to keep bot startup fast
+                import meraki
+                # Our session does the retrying, so the SDK makes one attempt
+                options = {"base_url": self.meraki_base_url} if self.meraki_base_url else {}
+                dashboard = meraki.DashboardAPI(
+                    self.meraki_api_key, output_log=False,
+                    single_request_timeout=self.timeout,
+                    maximum_retries=1, **options
+                )
+                # The SDK keeps one requests session per DashboardAPI; swap
+                # in a pooled, rate-limited one with the SDK's headers.
+                # That session is private, so an SDK without it keeps its own.
+                sdk_session = _meraki_requests_session(dashboard)
+                if sdk_session is not None:
+                    session = upstream_session(
+                        "Meraki", self.pool_size, self.timeout, self._policy("meraki"),
+                        key_limiter=self.meraki_org_limiter, limiter_key=self._meraki_org
+                    )
+                    session.headers.update(sdk_session.headers)
+                    dashboard._session._req_session = session
+                else:
+                    sys.stderr.write("meraki {} has no requests session to replace, Meraki calls are not "
+                                     "rate limited or retried by the bot\n".format(getattr(meraki, "__version__", "")))
+                self._meraki = dashboard
+            return self._meraki
+
+    def reset(self):
+        """
+        Forget existing sessions without closing them, so a forked worker
+        process opens its own connections instead of sharing the parent's.
+        """
+        with self._lock:
+            self._webex = self._umbrella = self._meraki = None
+
+    def close(self):
+        with self._lock:
+            for session in (self._webex, self._umbrella):
+                if session is not None:
+                    session.close()
+            if self._meraki is not None:
+                session = _meraki_requests_session(self._meraki)
+                if session is not None:
+                    session.close()
+            self._webex = self._umbrella = self._meraki = None
+
+
+def _meraki_requests_session(dashboard):
+    # DashboardAPI._session._req_session in the 0.x SDKs
+    session = getattr(getattr(dashboard, "_session", None), "_req_session", None)
+    return session if isinstance(session, requests.Session) else None
@@ -0,0 +1,27 @@
+import sys
+
+from webexteamsbot import TeamsBot
+
+
+class DeferredTeamsBot(TeamsBot):
+    """
+    TeamsBot that does not touch Webex while it is being built.
+
+    TeamsBot.__init__ registers the webhooks straight away; here that is
+    an explicit register_webhooks() step, so the bot can be built in
+    tests, benchmarks and worker processes without network access, and a
+    deployment whose webhooks are managed elsewhere can skip it.
+    """
+
+    def teams_setup(self):
+        # Called from TeamsBot.__init__; see register_webhooks()
+        pass
+
+    def register_webhooks(self):
+        """
+        Create or update this bot's Webex webhooks.
+        """
+        if not self.teams_bot_url:
+            sys.stderr.write("COB_BOT_URL is not set, skipping webhook registration\n")
+            return
+        super(DeferredTeamsBot, self).teams_setup()
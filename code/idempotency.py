@@ -0,0 +1,229 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+import contextvars
+import json
+from shared import ProcessConnection
+import threading
+import time
+
+
+# Set inside IdempotencyStore.run() while its function runs
+_outcome = contextvars.ContextVar("idempotency_outcome", default=None)
+
+
+def forget():
+    """
+    Ask the enclosing IdempotencyStore.run() not to remember the result
+    being produced, e.g. because it reports a failure the user may retry
+    by submitting again. Does nothing outside run().
+    """
+    outcome = _outcome.get()
+    if outcome is not None:
+        outcome["forget"] = True
+
+
+class SQLiteIdempotencyBackend(object):
+    """
+    Optional persistent store of completed keys, so duplicates are still
+    recognised after a restart or by another process sharing the file.
+    """
+
+    def __init__(self, path):
+        self._connection = ProcessConnection(path, setup=self._create)
+        self._lock = threading.Lock()
+
+    @property
+    def _db(self):
+        return self._connection.get()
+
+    def _create(self, db):
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS idempotency ("
+                "key TEXT PRIMARY KEY, result TEXT, expires_at REAL)"
+            )
+
+    def get(self, key):
+        """
+        :return: (found, result)
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT result, expires_at FROM idempotency WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or row[1] < time.time():
+            return False, None
+        return True, json.loads(row[0])
+
+    def set(self, key, result, ttl):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO idempotency VALUES (?, ?, ?)",
+                (key, json.dumps(result), time.time() + ttl)
+            )
+            # Opportunistically drop expired keys
+            self._db.execute("DELETE FROM idempotency WHERE expires_at < ?", (time.time(),))
+
+
+class SharedIdempotencyBackend(object):
+    """
+    Keeps keys in a SharedBackend and claims them atomically, so a webhook
+    redelivered to another worker process or host is not run twice.
+    """
+
+    def __init__(self, shared, claim_ttl=300, namespace="idempotency:"):
+        """
+        :param shared: SharedBackend used by every worker
+        :param claim_ttl: Seconds a claim is held if its owner never finishes
+        :param namespace: Prefix of the keys in the backend
+        """
+        self.shared = shared
+        self.claim_ttl = claim_ttl
+        self.namespace = namespace
+
+    def get(self, key):
+        """
+        :return: (found, result); keys still running elsewhere are not found
+        """
+        entry = self.shared.get(self.namespace + key)
+        if entry is None or "result" not in entry:
+            return False, None
+        return True, entry["result"]
+
+    def set(self, key, result, ttl):
+        self.shared.set(self.namespace + key, {"result": result}, ttl)
+
+    def claim(self, key):
+        """
+        :return: True if no other worker has claimed or completed key
+        """
+        return self.shared.add(self.namespace + key, {"claimed": True}, self.claim_ttl)
+
+    def release(self, key):
+        self.shared.delete(self.namespace + key)
+
+
+class IdempotencyStore(object):
+    """
+    Remembers which webhook events and card submissions were already
+    handled.
+
+    Completed keys are kept in a bounded LRU with a TTL (and optionally a
+    persistent backend); a key seen again returns the stored result. A key
+    that is still running makes the duplicate wait for, and reuse, the
+    result of the in-flight execution. Failed executions, and those that
+    call forget(), are not remembered so a retry can run again. A backend with claim/release also reserves keys
+    across processes.
+    """
+
+    def __init__(self, max_entries=10000, ttl=300, backend=None):
+        """
+        :param max_entries: Completed keys kept in memory
+        :param ttl: Seconds a completed key is remembered
+        :param backend: Optional persistent backend with get/set
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+        self._done = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        # Must be called with self._lock held
+        entry = self._done.get(key)
+        if entry is not None:
+            result, expires_at = entry
+            if expires_at > time.monotonic():
+                self._done.move_to_end(key)
+                return True, result
+            del self._done[key]
+        return False, None
+
+    def claim(self, key):
+        """
+        Mark key as in flight.
+        :return: True if the caller owns the key and must finish() it,
+                False if it was already completed or is running
+        """
+        with self._lock:
+            found, _ = self._lookup(key)
+            if found or key in self._inflight:
+                return False
+        if self.backend is not None:
+            found, result = self.backend.get(key)
+            if found:
+                self._remember(key, result)
+                return False
+        with self._lock:
+            if key in self._inflight:
+                return False
+            self._inflight[key] = Future()
+        if hasattr(self.backend, "claim") and not self.backend.claim(key):
+            # Running or done in another process
+            with self._lock:
+                self._inflight.pop(key).set_result(None)
+            return False
+        return True
+
+    def finish(self, key, result=None, error=None, remember=True):
+        """
+        Complete a claimed key. With an error, or remember=False, the key
+        is forgotten so the event can be retried; concurrent duplicates
+        still get the result.
+        """
+        with self._lock:
+            future = self._inflight.pop(key, None)
+        if error is None and remember:
+            self._remember(key, result)
+            if self.backend is not None:
+                self.backend.set(key, result, self.ttl)
+        elif hasattr(self.backend, "release"):
+            self.backend.release(key)
+        if future is not None:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def wait(self, key):
+        """
+        :return: The result of a completed or in-flight key, or None
+        """
+        with self._lock:
+            found, result = self._lookup(key)
+            if found:
+                return result
+            future = self._inflight.get(key)
+        if future is not None:
+            return future.result()
+        if self.backend is not None:
+            return self.backend.get(key)[1]
+        return None
+
+    def run(self, key, fn, *args):
+        """
+        Run fn(*args) once per key.
+        :return: (result, duplicate) where duplicate is True if the result
+                came from an earlier or concurrent execution
+        """
+        if not self.claim(key):
+            return self.wait(key), True
+        outcome = {"forget": False}
+        token = _outcome.set(outcome)
+        try:
+            result = fn(*args)
+        except Exception as e:
+            self.finish(key, error=e)
+            raise
+        finally:
+            _outcome.reset(token)
+        self.finish(key, result, remember=not outcome["forget"])
+        return result, False
+
+    def _remember(self, key, result):
+        with self._lock:
+            self._done[key] = (result, time.monotonic() + self.ttl)
+            self._done.move_to_end(key)
+            while len(self._done) > self.max_entries:
+                self._done.popitem(last=False)
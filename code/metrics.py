@@ -0,0 +1,297 @@
+from contextlib import contextmanager
+import contextvars
+import functools
+import json
+import sys
+import threading
+import time
+
+from shared import process_id
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Card type of the action being handled, used as a label on stage metrics
+card_type = contextvars.ContextVar("card_type", default="none")
+
+# Per-request trace (list of stage records) when trace logging is enabled
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ""
+    pairs = ['{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+             for n, v in zip(labelnames, values)]
+    return "{" + ",".join(pairs) + "}"
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(n, "") for n in self.labelnames)
+
+    def render(self, values=None):
+        """
+        :param values: Values to render instead of this process's own,
+                e.g. merged from several processes
+        """
+        lines = ["# HELP {} {}".format(self.name, self.help_text),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+        with self._lock:
+            for key, value in sorted((self._values if values is None else values).items()):
+                lines += self._render_value(key, value)
+        return lines
+
+    def snapshot(self):
+        """
+        :return: This process's values as a JSON-serializable list
+        """
+        with self._lock:
+            return [[list(key), list(value) if isinstance(value, list) else value]
+                    for key, value in self._values.items()]
+
+    def _render_value(self, key, value):
+        return ["{}{} {}".format(self.name, _format_labels(self.labelnames, key), value)]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One slot per bucket, then sum and count
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def _render_value(self, key, counts):
+        names = self.labelnames + ("le",)
+        lines = []
+        for bound, count in zip(self.buckets, counts):
+            lines.append("{}_bucket{} {}".format(self.name, _format_labels(names, key + (bound,)), count))
+        lines.append("{}_bucket{} {}".format(self.name, _format_labels(names, key + ("+Inf",)), counts[-1]))
+        labels = _format_labels(self.labelnames, key)
+        lines.append("{}_sum{} {}".format(self.name, labels, counts[-2]))
+        lines.append("{}_count{} {}".format(self.name, labels, counts[-1]))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self, snapshots=None):
+        """
+        :param snapshots: Optional snapshot() results of several processes,
+                rendered summed instead of this process's own values
+        :return: All metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in self._metrics:
+            if snapshots is None:
+                lines += metric.render()
+            else:
+                lines += metric.render(_merge(s.get(metric.name, ()) for s in snapshots))
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """
+        :return: Dict of metric name -> Metric.snapshot()
+        """
+        return dict((metric.name, metric.snapshot()) for metric in self._metrics)
+
+
+def _merge(snapshots):
+    # Sum counters, gauges and histogram buckets of the same labels
+    values = {}
+    for entries in snapshots:
+        for key, value in entries:
+            key = tuple(key)
+            current = values.get(key)
+            if current is None:
+                values[key] = value
+            elif isinstance(value, list):
+                values[key] = [a + b for a, b in zip(current, value)]
+            else:
+                values[key] = current + value
+    return values
+
+
+class SharedMetrics(object):
+    """
+    Publishes this process's metrics to a SharedBackend every interval
+    seconds and renders the sum over every live process, so a scrape that
+    lands on any worker reports the whole deployment. A process that stops
+    publishing drops out after a few intervals.
+    """
+
+    def __init__(self, backend, registry=None, interval=15, namespace="metrics:"):
+        self.backend = backend
+        self.registry = registry or REGISTRY
+        self.interval = interval
+        self.namespace = namespace
+        self._stop = threading.Event()
+        self._thread = None
+
+    def publish(self):
+        self.backend.set(self.namespace + process_id(), self.registry.snapshot(), 3 * self.interval)
+
+    def render(self):
+        self.publish()
+        return self.registry.render(list(self.backend.items(self.namespace).values()))
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="metrics-publish", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.publish()
+            except Exception as e:
+                sys.stderr.write("Metrics publish failed: {}\n".format(e))
+
+
+REGISTRY = Registry()
+
+STAGE_LATENCY = REGISTRY.register(Histogram(
+    "cob_stage_latency_seconds", "Latency of outbound calls and processing stages.",
+    ("stage", "card_type")))
+STAGE_ERRORS = REGISTRY.register(Counter(
+    "cob_stage_errors_total", "Stages that raised an exception.",
+    ("stage", "card_type")))
+STAGE_IN_FLIGHT = REGISTRY.register(Gauge(
+    "cob_stage_in_flight", "Stages currently running.",
+    ("stage", "card_type")))
+SCHEDULER_QUEUED = REGISTRY.register(Gauge(
+    "cob_scheduler_queue_depth", "Requests waiting for a slot.",
+    ("cost_class",)))
+SCHEDULER_RUNNING = REGISTRY.register(Gauge(
+    "cob_scheduler_in_flight", "Requests holding a slot.",
+    ("cost_class",)))
+SCHEDULER_WAIT = REGISTRY.register(Histogram(
+    "cob_scheduler_wait_seconds", "Time requests waited for a slot.",
+    ("cost_class",)))
+SCHEDULER_REJECTED = REGISTRY.register(Counter(
+    "cob_scheduler_rejected_total", "Requests turned away with a busy reply.",
+    ("cost_class", "reason")))
+
+
+@contextmanager
+def track(stage):
+    """
+    Time a stage, counting errors and in-flight executions, labelled with
+    the current card type.
+    """
+    labels = {"stage": stage, "card_type": card_type.get()}
+    STAGE_IN_FLIGHT.inc(**labels)
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = e
+        STAGE_ERRORS.inc(**labels)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_IN_FLIGHT.dec(**labels)
+        STAGE_LATENCY.observe(elapsed, **labels)
+        trace = _trace.get()
+        if trace is not None:
+            trace.append({"stage": stage, "card_type": labels["card_type"],
+                          "seconds": round(elapsed, 6),
+                          "error": repr(error) if error is not None else None})
+
+
+def timed(stage):
+    """
+    Decorator form of track().
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with track(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TraceLog(object):
+    """
+    Optional per-request trace log: one JSON line per handled request with
+    every stage it went through.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def request(self, request_id):
+        if not self.path:
+            yield
+            return
+        stages = []
+        token = _trace.set(stages)
+        start = time.time()
+        try:
+            yield
+        finally:
+            _trace.reset(token)
+            record = {"request_id": request_id, "start": start,
+                      "seconds": round(time.time() - start, 6), "stages": stages}
+            with self._lock, open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
@@ -0,0 +1,146 @@
+from shared import ProcessConnection
+import sys
+import threading
+import time
+
+
+def _like_escape(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class NetworkIndex(object):
+    """
+    Locally persisted index of every Meraki org and network the API key can
+    see, answering prefix and substring name searches from SQLite instead
+    of listing networks from the API.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: SQLite database file
+        """
+        self._connection = ProcessConnection(path, setup=self._create)
+        self._lock = threading.Lock()
+
+    @property
+    def _db(self):
+        return self._connection.get()
+
+    def _create(self, db):
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS orgs ("
+                "org_id TEXT PRIMARY KEY, name TEXT, synced_at REAL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS networks ("
+                "network_id TEXT PRIMARY KEY, org_id TEXT, name TEXT, name_lower TEXT)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS networks_name ON networks (name_lower)"
+            )
+
+    def network_ids(self):
+        with self._lock:
+            return [network_id for (network_id,) in self._db.execute("SELECT network_id FROM networks")]
+
+    def update_org(self, org_id, org_name, networks):
+        """
+        Bring one org's networks up to date, touching only changed rows.
+        :param org_id: Organization id
+        :param org_name: Organization name
+        :param networks: List of (name, network_id)
+        :return: Number of networks added, renamed or removed
+        """
+        org_id = str(org_id)
+        with self._lock, self._db:
+            current = dict(self._db.execute(
+                "SELECT network_id, name FROM networks WHERE org_id = ?", (org_id,)))
+            latest = dict((str(network_id), name) for name, network_id in networks)
+            changed = [(network_id, org_id, name, name.lower())
+                       for network_id, name in latest.items() if current.get(network_id) != name]
+            removed = [(network_id,) for network_id in current if network_id not in latest]
+            self._db.executemany("INSERT OR REPLACE INTO networks VALUES (?, ?, ?, ?)", changed)
+            self._db.executemany("DELETE FROM networks WHERE network_id = ?", removed)
+            self._db.execute("INSERT OR REPLACE INTO orgs VALUES (?, ?, ?)", (org_id, org_name, time.time()))
+        return len(changed) + len(removed)
+
+    def remove_orgs_except(self, org_ids):
+        org_ids = set(str(org_id) for org_id in org_ids)
+        with self._lock, self._db:
+            stale = [(org_id,) for (org_id,) in self._db.execute("SELECT org_id FROM orgs")
+                     if org_id not in org_ids]
+            self._db.executemany("DELETE FROM networks WHERE org_id = ?", stale)
+            self._db.executemany("DELETE FROM orgs WHERE org_id = ?", stale)
+
+    def search(self, query, limit=20, offset=0):
+        """
+        Find networks whose name starts with, then contains, query
+        (case-insensitive).
+        :return: (total matches, list of (network name, network id, org name))
+        """
+        query = query.strip().lower()
+        pattern = "%" + _like_escape(query) + "%"
+        # Prefix matches sort first, then other substring matches by name
+        where = "n.name_lower LIKE ? ESCAPE '\\'"
+        with self._lock:
+            total = self._db.execute(
+                "SELECT COUNT(*) FROM networks n WHERE " + where, (pattern,)).fetchone()[0]
+            rows = self._db.execute(
+                "SELECT n.name, n.network_id, o.name FROM networks n "
+                "LEFT JOIN orgs o ON o.org_id = n.org_id WHERE " + where + " "
+                "ORDER BY (n.name_lower >= ? AND n.name_lower < ?) DESC, n.name_lower "
+                "LIMIT ? OFFSET ?",
+                (pattern, query, query + "\uffff", limit, offset)
+            ).fetchall()
+        return total, rows
+
+
+class NetworkIndexRefresher(object):
+    """
+    Background thread that re-lists orgs and networks every interval
+    seconds and applies the changes to a NetworkIndex one org at a time.
+    """
+
+    def __init__(self, index, list_orgs, list_networks, interval=900):
+        """
+        :param index: NetworkIndex to keep up to date
+        :param list_orgs: Callable returning [(org name, org id)]
+        :param list_networks: Callable taking an org id, returning
+                [(network name, network id)]
+        :param interval: Seconds between refreshes
+        """
+        self.index = index
+        self.list_orgs = list_orgs
+        self.list_networks = list_networks
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        orgs = self.list_orgs()
+        changes = 0
+        for org_name, org_id in orgs:
+            try:
+                changes += self.index.update_org(org_id, org_name, self.list_networks(org_id))
+            except Exception as e:
+                sys.stderr.write("Network index refresh of org {} failed: {}\n".format(org_id, e))
+        self.index.remove_orgs_except([org_id for _, org_id in orgs])
+        return changes
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="network-index", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                sys.stderr.write("Network index refresh failed: {}\n".format(e))
+            self._stop.wait(self.interval)
@@ -0,0 +1,144 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import random
+import sys
+import threading
+import time
+
+from shared import process_id
+
+# Seconds a process's request counts stay in the shared backend after its
+# last traffic request
+REQUESTS_TTL = 86400
+
+
+class ChartPrefetcher(object):
+    """
+    Keeps traffic charts warm for an allowlist of networks plus the most
+    requested ones.
+
+    Every interval seconds each target network's traffic is fetched and its
+    chart rendered, with at most max_workers networks in flight and each
+    start delayed by a random jitter so refreshes don't burst against the
+    Meraki rate limit. Cards then serve the ready image together with its
+    age.
+
+    With a shared backend the ready charts and every process's request
+    counts live in the backend, so charts prefetched by the elected leader
+    are served by every worker and the most requested networks are counted
+    across all of them.
+    """
+
+    def __init__(self, render, interval=600, allowlist=(), top_n=10, jitter=60,
+                 max_workers=2, max_age=None, is_available=None, store=None, namespace="prefetch:"):
+        """
+        :param render: Callable taking a network id and returning an image name
+        :param interval: Seconds between refresh rounds
+        :param allowlist: Network ids always kept warm
+        :param top_n: Number of most requested networks also kept warm
+        :param jitter: Maximum random delay in seconds before each refresh
+        :param max_workers: Networks refreshed concurrently
+        :param max_age: Seconds a chart may be served, defaults to 2 intervals
+        :param is_available: Optional callable telling whether an image
+                still exists
+        :param store: Optional SharedBackend for ready charts and request
+                counts
+        :param namespace: Prefix of the keys in the backend
+        """
+        self.render = render
+        self.interval = interval
+        self.allowlist = list(allowlist)
+        self.top_n = top_n
+        self.jitter = jitter
+        self.max_workers = max_workers
+        self.max_age = max_age if max_age is not None else 2 * interval
+        self.is_available = is_available
+        self.store = store
+        self.namespace = namespace
+        self._requests = Counter()
+        self._ready = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def record_request(self, network_id):
+        with self._lock:
+            self._requests[network_id] += 1
+            counts = dict(self._requests)
+        if self.store is not None:
+            self.store.set(self.namespace + "requests:" + process_id(), counts, REQUESTS_TTL)
+
+    def put(self, network_id, image_name, generated_at=None):
+        entry = (image_name, generated_at or time.time())
+        if self.store is not None:
+            self.store.set(self.namespace + "ready:" + network_id, list(entry), self.max_age)
+            return
+        with self._lock:
+            self._ready[network_id] = entry
+
+    def ready(self, network_id):
+        """
+        :return: (image name, generated_at) of a fresh enough chart, or None
+        """
+        if self.store is not None:
+            entry = self.store.get(self.namespace + "ready:" + network_id)
+        else:
+            with self._lock:
+                entry = self._ready.get(network_id)
+        if entry is None or time.time() - entry[1] > self.max_age:
+            return None
+        if self.is_available is not None and not self.is_available(entry[0]):
+            return None
+        return entry
+
+    def targets(self):
+        if self.store is not None:
+            requests = Counter()
+            for counts in self.store.items(self.namespace + "requests:").values():
+                requests.update(counts)
+        else:
+            with self._lock:
+                requests = Counter(self._requests)
+        popular = [n for n, _ in requests.most_common(self.top_n)] if self.top_n else []
+        return list(dict.fromkeys(self.allowlist + popular))
+
+    def refresh(self, network_id):
+        time.sleep(random.uniform(0, self.jitter))
+        if self._stop.is_set():
+            return
+        self.put(network_id, self.render(network_id))
+
+    def run_once(self):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for future in [pool.submit(self.refresh, n) for n in self.targets()]:
+                try:
+                    future.result()
+                except Exception as e:
+                    sys.stderr.write("Chart prefetch failed: {}\n".format(e))
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="chart-prefetch", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.run_once()
+            self._stop.wait(self.interval)
+
+
+def describe_age(seconds):
+    """
+    Human readable age of a chart, e.g. "Updated 5 minutes ago".
+    """
+    minutes = int(seconds // 60)
+    if minutes < 1:
+        return "Updated just now"
+    if minutes < 60:
+        return "Updated {} minute{} ago".format(minutes, "" if minutes == 1 else "s")
+    hours = minutes // 60
+    return "Updated {} hour{} ago".format(hours, "" if hours == 1 else "s")
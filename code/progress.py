@@ -0,0 +1,101 @@
+import contextvars
+import sys
+import threading
+import time
+
+# Placeholder of the progressive reply running in this context, if any
+current = contextvars.ContextVar("progress", default=None)
+
+
+def report(text):
+    """
+    Report partial progress of the current operation, e.g. "Fetched 40/120
+    networks". Does nothing outside a progressive reply.
+    """
+    progress = current.get()
+    if progress is not None:
+        progress.update(text)
+
+
+class Progress(object):
+    """
+    Placeholder message posted as soon as a slow operation starts, edited
+    as its stages report progress and finally replaced by the result.
+
+    Webex only allows a message to be edited a few times, so updates are
+    throttled to one per min_interval seconds and one edit is kept back
+    for the final text. Used as a context manager; a placeholder that was
+    not turned into the final reply is deleted on exit.
+    """
+
+    def __init__(self, post, edit, delete, room_id, text, min_interval=3, max_edits=10, enabled=True):
+        """
+        :param post: Callable taking (room id, markdown), returning a message id
+        :param edit: Callable taking (message id, room id, markdown)
+        :param delete: Callable taking a message id
+        :param room_id: Room to post the placeholder in
+        :param text: Placeholder markdown
+        :param min_interval: Minimum seconds between progress edits
+        :param max_edits: Edits Webex allows per message
+        :param enabled: False makes every step a no-op
+        """
+        self.post = post
+        self.edit = edit
+        self.delete = delete
+        self.room_id = room_id
+        self.text = text
+        self.min_interval = min_interval
+        self.max_edits = max_edits
+        self.enabled = enabled
+        self.message_id = None
+        self._edits = 0
+        self._last_edit = 0
+        self._final = False
+        self._lock = threading.Lock()
+        self._token = None
+
+    def __enter__(self):
+        if self.enabled:
+            self.message_id = self._call(self.post, self.room_id, self.text)
+        self._token = current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        current.reset(self._token)
+        if self.message_id is not None and not self._final:
+            self._call(self.delete, self.message_id)
+        return False
+
+    def update(self, text):
+        now = time.monotonic()
+        with self._lock:
+            if (self.message_id is None or self._final or self._edits >= self.max_edits - 1
+                    or now - self._last_edit < self.min_interval):
+                return
+            self._edits += 1
+            self._last_edit = now
+        self._call(self.edit, self.message_id, self.room_id, text)
+
+    def reply(self, text):
+        """
+        Turn the placeholder into the final text reply.
+        :return: "" if the placeholder now shows text, else text itself
+                for the caller to post
+        """
+        with self._lock:
+            if self.message_id is None or self._edits >= self.max_edits:
+                return text
+            self._edits += 1
+            self._final = True
+        if self._call(self.edit, self.message_id, self.room_id, text) is None:
+            self._final = False
+            return text
+        return ""
+
+    def _call(self, fn, *args):
+        # A failed placeholder must never fail the operation itself
+        try:
+            return fn(*args)
+        except Exception as e:
+            sys.stderr.write("Progress message failed: {}\n".format(e))
+            return None
@@ -0,0 +1,157 @@
+import email.utils
+import random
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket. Each acquire() takes one token, blocking until
+    one is available; tokens refill continuously at rate per second up to
+    capacity.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: Tokens added per second
+        :param capacity: Maximum burst size, defaults to rate
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class KeyedLimiter(object):
+    """
+    Lazily creates one TokenBucket per key, e.g. per Meraki organization.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.capacity)
+                self._buckets[key] = bucket
+            return bucket
+
+
+class UpstreamUnavailable(Exception):
+    """
+    Raised when an upstream is throttling us past our retry budget or its
+    circuit breaker is open.
+    """
+
+    def __init__(self, upstream, reason):
+        super(UpstreamUnavailable, self).__init__("{} unavailable: {}".format(upstream, reason))
+        self.upstream = upstream
+        self.reason = reason
+
+
+class CircuitBreaker(object):
+    """
+    Opens after failure_threshold consecutive failures and fails fast for
+    reset_timeout seconds; then lets one trial call through (half-open)
+    and closes again if it succeeds. Call before() once per logical
+    request and done() when it ends, however it ends, so a trial that
+    neither succeeded nor failed doesn't keep the breaker open.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def before(self):
+        """
+        :return: True if this request is the half-open trial
+        :raises UpstreamUnavailable: if the breaker is open
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial:
+                raise UpstreamUnavailable(self.name, "circuit open")
+            self._trial = True
+            return True
+
+    def done(self, trial):
+        """
+        :param trial: What before() returned for the finished request
+        """
+        if trial:
+            with self._lock:
+                self._trial = False
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+def retry_after(response):
+    """
+    :return: Seconds to wait according to a Retry-After header, or None
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def backoff(attempt, base=0.5, cap=30.0):
+    """
+    Full-jitter exponential backoff for the given retry attempt (0-based).
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
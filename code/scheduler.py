@@ -0,0 +1,178 @@
+from concurrent.futures import Future
+import heapq
+import itertools
+import threading
+import time
+
+import metrics
+
+
+class Busy(Exception):
+    """
+    Raised when a request is turned away instead of queued.
+    """
+
+    def __init__(self, reason):
+        super(Busy, self).__init__("Busy: {} limit reached".format(reason))
+        self.reason = reason
+
+
+class _Job(object):
+    __slots__ = ("room", "user", "cost_class", "start", "enqueued_at")
+
+    def __init__(self, room, user, cost_class):
+        self.room = room
+        self.user = user
+        self.cost_class = cost_class
+        self.start = None
+        self.enqueued_at = time.monotonic()
+
+
+class FairScheduler(object):
+    """
+    Admission control and weighted fair queuing for webhook work.
+
+    A request is turned away at once with Busy when its room or user
+    already has room_limit / user_limit requests queued or running, or
+    when max_in_flight requests are running and max_queue are waiting.
+
+    Waiting requests are ordered by self-clocked weighted fair queuing:
+    each room is a flow, and a request's finish tag advances its room by
+    1 / weight of its cost class, so rooms share slots evenly and cheap
+    classes (higher weight) overtake expensive ones.
+    """
+
+    def __init__(self, max_in_flight=8, max_queue=50, room_limit=2, user_limit=3, weights=None):
+        """
+        :param max_in_flight: Requests running at once
+        :param max_queue: Requests waiting for a slot
+        :param room_limit: Requests queued or running per room
+        :param user_limit: Requests queued or running per user
+        :param weights: Dict of cost class -> weight; unknown classes
+                weigh 1
+        """
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.room_limit = room_limit
+        self.user_limit = user_limit
+        self.weights = dict(weights or {"light": 4, "heavy": 1})
+        self._queue = []
+        self._seq = itertools.count()
+        self._vtime = 0.0
+        self._last_finish = {}
+        self._rooms = {}
+        self._users = {}
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def run(self, room, user, cost_class, fn, *args):
+        """
+        Wait for a slot, then run fn(*args) in the calling thread.
+        :return: fn's result
+        :raises Busy: If the request was not admitted
+        """
+        job = _Job(room, user, cost_class)
+        ready = threading.Event()
+        job.start = ready.set
+        self._admit(job)
+        ready.wait()
+        try:
+            return fn(*args)
+        finally:
+            self._release(job)
+
+    def submit(self, execute, room, user, cost_class, fn, *args):
+        """
+        Once a slot is free, hand fn(*args) to execute, e.g.
+        WorkerPool.submit, which returns a Future or None when full.
+        :return: A Future of fn's result
+        :raises Busy: If the request was not admitted
+        """
+        job = _Job(room, user, cost_class)
+        result = Future()
+
+        def start():
+            try:
+                future = execute(fn, *args)
+            except Exception as e:
+                self._release(job)
+                result.set_exception(e)
+                return
+            if future is None:
+                self._release(job)
+                result.set_exception(Busy("workers"))
+                return
+            future.add_done_callback(lambda f: finish(f))
+
+        def finish(future):
+            self._release(job)
+            if future.exception() is not None:
+                result.set_exception(future.exception())
+            else:
+                result.set_result(future.result())
+
+        job.start = start
+        self._admit(job)
+        return result
+
+    def _admit(self, job):
+        with self._lock:
+            reason = None
+            if self._rooms.get(job.room, 0) >= self.room_limit:
+                reason = "room"
+            elif self._users.get(job.user, 0) >= self.user_limit:
+                reason = "user"
+            elif self._in_flight >= self.max_in_flight and len(self._queue) >= self.max_queue:
+                reason = "queue"
+            if reason is not None:
+                metrics.SCHEDULER_REJECTED.inc(cost_class=job.cost_class, reason=reason)
+                raise Busy(reason)
+            self._rooms[job.room] = self._rooms.get(job.room, 0) + 1
+            self._users[job.user] = self._users.get(job.user, 0) + 1
+            start = max(self._vtime, self._last_finish.get(job.room, 0.0))
+            finish = start + 1.0 / self.weights.get(job.cost_class, 1)
+            self._last_finish[job.room] = finish
+            heapq.heappush(self._queue, (finish, next(self._seq), job))
+            metrics.SCHEDULER_QUEUED.inc(cost_class=job.cost_class)
+            ready = self._dispatch()
+        self._start(ready)
+
+    def _release(self, job):
+        with self._lock:
+            self._in_flight -= 1
+            metrics.SCHEDULER_RUNNING.dec(cost_class=job.cost_class)
+            self._rooms[job.room] -= 1
+            if not self._rooms[job.room]:
+                del self._rooms[job.room]
+                self._last_finish.pop(job.room, None)
+            self._users[job.user] -= 1
+            if not self._users[job.user]:
+                del self._users[job.user]
+            ready = self._dispatch()
+        self._start(ready)
+
+    # Must be called with self._lock held
+    def _dispatch(self):
+        ready = []
+        while self._queue and self._in_flight < self.max_in_flight:
+            finish, _, job = heapq.heappop(self._queue)
+            self._vtime = finish
+            self._in_flight += 1
+            metrics.SCHEDULER_QUEUED.dec(cost_class=job.cost_class)
+            metrics.SCHEDULER_RUNNING.inc(cost_class=job.cost_class)
+            ready.append(job)
+        return ready
+
+    def _start(self, jobs):
+        now = time.monotonic()
+        for job in jobs:
+            metrics.SCHEDULER_WAIT.observe(now - job.enqueued_at, cost_class=job.cost_class)
+            job.start()
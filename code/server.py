@@ -0,0 +1,70 @@
+"""
+Production entry point: serves the bot with several gunicorn worker
+processes instead of Flask's development server.
+
+    python server.py
+
+or with gunicorn's own command line:
+
+    gunicorn -w 4 -k gthread --threads 8 -b 0.0.0.0:5000 "server:create_worker_app()"
+
+Workers share caches, idempotency keys, chart images and room locks
+through the shared backend (SHARED_BACKEND, "sqlite" by default here),
+and elect one of themselves to register webhooks and run the background
+refreshes. bot.py is only imported inside each worker, so no SQLite
+connection or thread is inherited across the fork.
+"""
+import os
+
+from dotenv import load_dotenv
+from gunicorn.app.base import BaseApplication
+
+load_dotenv()
+
+# Several processes need shared state
+if not os.getenv("SHARED_BACKEND"):
+    os.environ["SHARED_BACKEND"] = "sqlite"
+
+# WSGI server settings
+web_bind = os.getenv("WEB_BIND", "0.0.0.0:5000")
+web_workers = int(os.getenv("WEB_WORKERS", "4"))
+web_threads = int(os.getenv("WEB_THREADS", "8"))
+web_timeout = int(os.getenv("WEB_TIMEOUT", "60"))
+
+
+def create_worker_app():
+    """
+    Build the bot in a worker process.
+    :return: The bot, a WSGI application
+    """
+    import bot
+    return bot.create_app(webhooks=bot.register_webhooks, warm=bot.warm_up_on_start, elect=True)
+
+
+class BotApplication(BaseApplication):
+    """
+    Runs gunicorn with options from the environment and the bot as the
+    application of every worker.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        super(BotApplication, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return create_worker_app()
+
+
+if __name__ == "__main__":
+    BotApplication({
+        "bind": web_bind,
+        "workers": web_workers,
+        "worker_class": "gthread",
+        "threads": web_threads,
+        "timeout": web_timeout,
+        "preload_app": False
+    }).run()
@@ -0,0 +1,346 @@
+from contextlib import ExitStack, contextmanager
+import importlib
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+
+def process_id():
+    """
+    :return: Id of this process, unique across the hosts sharing a backend
+    """
+    return "{}-{}".format(socket.gethostname(), os.getpid())
+
+
+class ProcessConnection(object):
+    """
+    SQLite connection opened on first use, so building the object that owns
+    it creates no file or directory. Connections can't be shared with
+    forked worker processes, so each process opens its own.
+    """
+
+    def __init__(self, path, setup=None):
+        """
+        :param path: SQLite database file
+        :param setup: Optional callable run with each new connection, e.g.
+                to create tables
+        """
+        self.path = path
+        self.setup = setup
+        self._connection = None
+        self._pid = None
+
+    def get(self):
+        if self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._pid = os.getpid()
+            if self.setup is not None:
+                self.setup(self._connection)
+        return self._connection
+
+
+class SharedBackend(object):
+    """
+    State shared by every worker process and host serving the bot: small
+    JSON values with a TTL, binary blobs (rendered charts) and leases used
+    for locks and leader election.
+
+    Subclasses implement the storage; lock() is built on lease().
+    """
+
+    def get(self, key):
+        """
+        :return: The value stored under key, or None if absent or expired
+        """
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError
+
+    def add(self, key, value, ttl):
+        """
+        Store value only if key is absent or expired.
+        :return: True if the value was stored
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def delete_prefix(self, prefix):
+        raise NotImplementedError
+
+    def items(self, prefix):
+        """
+        :return: Dict of key -> value of every live key starting with prefix
+        """
+        raise NotImplementedError
+
+    def lease(self, key, owner, ttl):
+        """
+        Take key for owner if it is free or expired, or renew it if owner
+        already holds it.
+        :return: True if owner holds the lease
+        """
+        raise NotImplementedError
+
+    def release(self, key, owner):
+        raise NotImplementedError
+
+    def put_blob(self, name, data):
+        raise NotImplementedError
+
+    def get_blob(self, name):
+        """
+        :return: The blob's bytes, or None if it does not exist
+        """
+        raise NotImplementedError
+
+    def has_blob(self, name):
+        raise NotImplementedError
+
+    def delete_blob(self, name):
+        raise NotImplementedError
+
+    @contextmanager
+    def lock(self, key, ttl=120, timeout=120, poll_interval=0.05):
+        """
+        Hold key exclusively across processes and hosts. The lease expires
+        after ttl seconds so a crashed holder can't block others forever.
+        :param timeout: Seconds to wait before giving up with TimeoutError
+        """
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout
+        while not self.lease(key, owner, ttl):
+            if time.monotonic() > deadline:
+                raise TimeoutError("Timed out waiting for lock {}".format(key))
+            time.sleep(poll_interval)
+        try:
+            yield
+        finally:
+            self.release(key, owner)
+
+
+class SQLiteSharedBackend(SharedBackend):
+    """
+    Local implementation for one host or a shared volume: values and
+    leases in a SQLite database, blobs as files in a directory.
+    """
+
+    def __init__(self, location, blob_path=None):
+        """
+        :param location: Directory holding shared.db
+        :param blob_path: Directory holding the blobs, by default "blobs"
+                under location
+        """
+        self.location = location
+        self.blob_path = blob_path or os.path.join(location, "blobs")
+        self._connection = ProcessConnection(os.path.join(location, "shared.db"), setup=self._create)
+        self._lock = threading.Lock()
+
+    # Must be used with self._lock held
+    @property
+    def _db(self):
+        return self._connection.get()
+
+    def _create(self, db):
+        db.execute("PRAGMA journal_mode=WAL")
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)"
+            )
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM kv WHERE key = ? AND expires_at >= ?", (key, time.time())
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO kv VALUES (?, ?, ?)", (key, json.dumps(value), time.time() + ttl)
+            )
+            # Opportunistically drop expired keys
+            self._db.execute("DELETE FROM kv WHERE expires_at < ?", (time.time(),))
+
+    def _upsert(self, key, value, ttl, condition, params):
+        now = time.time()
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                "INSERT INTO kv VALUES (?, ?, ?) ON CONFLICT(key) DO UPDATE SET "
+                "value = excluded.value, expires_at = excluded.expires_at WHERE " + condition,
+                (key, json.dumps(value), now + ttl) + params + (now,)
+            )
+            return cursor.rowcount > 0
+
+    def add(self, key, value, ttl):
+        return self._upsert(key, value, ttl, "kv.expires_at < ?", ())
+
+    def lease(self, key, owner, ttl):
+        return self._upsert(key, owner, ttl, "kv.value = ? OR kv.expires_at < ?", (json.dumps(owner),))
+
+    def release(self, key, owner):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM kv WHERE key = ? AND value = ?", (key, json.dumps(owner)))
+
+    def delete(self, key):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def delete_prefix(self, prefix):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM kv WHERE substr(key, 1, ?) = ?", (len(prefix), prefix))
+
+    def items(self, prefix):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT key, value FROM kv WHERE substr(key, 1, ?) = ? AND expires_at >= ?",
+                (len(prefix), prefix, time.time())
+            ).fetchall()
+        return dict((key, json.loads(value)) for key, value in rows)
+
+    def _blob(self, name):
+        return os.path.join(self.blob_path, os.path.basename(name))
+
+    def put_blob(self, name, data):
+        # Write then rename so readers never see a partial file
+        os.makedirs(self.blob_path, exist_ok=True)
+        path = self._blob(name)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def get_blob(self, name):
+        try:
+            with open(self._blob(name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def has_blob(self, name):
+        return os.path.exists(self._blob(name))
+
+    def delete_blob(self, name):
+        try:
+            os.remove(self._blob(name))
+        except FileNotFoundError:
+            pass
+
+
+# Backends selectable by name; others can be given as "module:callable"
+BACKENDS = {"sqlite": SQLiteSharedBackend}
+
+
+def create_backend(name, location, **options):
+    """
+    :param name: A name from BACKENDS, or "module:callable" for a backend
+            implemented elsewhere (e.g. on Redis)
+    :param location: Backend-specific location, e.g. a directory or URL
+    :param options: Backend-specific keyword arguments
+    :return: A SharedBackend
+    """
+    if ":" in name:
+        module, attr = name.split(":", 1)
+        factory = getattr(importlib.import_module(module), attr)
+    elif name in BACKENDS:
+        factory = BACKENDS[name]
+    else:
+        raise ValueError("Unknown shared backend: {}".format(name))
+    return factory(location, **options)
+
+
+class RoomSequencer(object):
+    """
+    Runs work for the same room one at a time, so replies to a room don't
+    interleave. Threads in this process queue on a local lock; with a
+    shared backend the room is also locked across processes and hosts.
+    """
+
+    def __init__(self, backend=None, ttl=120, timeout=120):
+        """
+        :param backend: Optional SharedBackend for cross-process ordering
+        :param ttl: Seconds a room lock is held at most
+        :param timeout: Seconds to wait for a room before running anyway
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self.timeout = timeout
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, room_id):
+        with self._lock:
+            entry = self._locks.setdefault(room_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0], ExitStack() as stack:
+                if self.backend is not None:
+                    try:
+                        stack.enter_context(self.backend.lock("room:" + room_id, self.ttl, self.timeout))
+                    except TimeoutError as e:
+                        sys.stderr.write("{}, running unordered\n".format(e))
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[room_id]
+
+
+class LeaderLease(object):
+    """
+    Elects one process among all workers to run singleton work, such as
+    webhook registration and background refreshes. The lease is renewed
+    every ttl / 3 seconds; if the leader dies another process takes over
+    once it expires.
+    """
+
+    def __init__(self, backend, name, ttl=30, on_elected=None, on_lost=None):
+        self.backend = backend
+        self.name = name
+        self.ttl = ttl
+        self.on_elected = on_elected
+        self.on_lost = on_lost
+        self.owner = "{}:{}".format(os.getpid(), uuid.uuid4().hex)
+        self.leading = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="leader-lease", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self.leading:
+            self.backend.release(self.name, self.owner)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                held = self.backend.lease(self.name, self.owner, self.ttl)
+            except Exception as e:
+                sys.stderr.write("Leader lease renewal failed: {}\n".format(e))
+                held = False
+            if held != self.leading:
+                self.leading = held
+                callback = self.on_elected if held else self.on_lost
+                if callback is not None:
+                    try:
+                        callback()
+                    except Exception as e:
+                        sys.stderr.write("Leader callback failed: {}\n".format(e))
+            self._stop.wait(self.ttl / 3.0)
@@ -0,0 +1,145 @@
+"""
+UpstreamSession retries and CircuitBreaker transitions against a local
+HTTP stub that answers with scripted status codes.
+
+    python -m pytest code/tests
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import sys
+import threading
+import time
+import types
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import clients  # noqa: E402
+from clients import UpstreamPolicy, upstream_session  # noqa: E402
+from ratelimit import CircuitBreaker, UpstreamUnavailable  # noqa: E402
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def _answer(self):
+        self.server.requests.append(self.command)
+        status, headers = self.server.script.pop(0) if self.server.script else (200, {})
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_GET = do_POST = _answer
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.script = []
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = "http://127.0.0.1:{}/".format(server.server_port)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def waits(monkeypatch):
+    # Record retry waits instead of sleeping through them
+    waits = []
+    monkeypatch.setattr(clients, "time", types.SimpleNamespace(sleep=waits.append))
+    return waits
+
+
+def session(max_retries=3, failure_threshold=5, reset_timeout=30):
+    policy = UpstreamPolicy(rate=1000, max_retries=max_retries, failure_threshold=failure_threshold,
+                            reset_timeout=reset_timeout)
+    return upstream_session("Stub", pool_size=2, timeout=5, policy=policy)
+
+
+def test_retry_after_is_honoured(stub, waits):
+    stub.script = [(429, {"Retry-After": "2"}), (200, {})]
+    assert session().get(stub.url).status_code == 200
+    assert stub.requests == ["GET", "GET"]
+    assert 2 <= waits[0] <= 3
+
+
+def test_exhausted_retries_raise_unavailable(stub, waits):
+    stub.script = [(429, {"Retry-After": "0"})] * 3
+    with pytest.raises(UpstreamUnavailable):
+        session(max_retries=2).get(stub.url)
+    assert len(stub.requests) == 3
+
+
+def test_post_retried_on_429_only(stub, waits):
+    stub.script = [(429, {"Retry-After": "0"}), (200, {})]
+    assert session().post(stub.url).status_code == 200
+    stub.requests[:] = []
+    stub.script = [(500, {}), (200, {})]
+    assert session().post(stub.url).status_code == 500
+    assert stub.requests == ["POST"]
+
+
+def test_get_retried_on_5xx(stub, waits):
+    stub.script = [(502, {}), (503, {}), (200, {})]
+    assert session().get(stub.url).status_code == 200
+    assert len(stub.requests) == 3
+
+
+def test_breaker_opens_half_opens_and_closes(stub, waits):
+    s = session(max_retries=0, failure_threshold=2, reset_timeout=0.2)
+    stub.script = [(500, {}), (500, {})]
+    s.get(stub.url)
+    assert s.breaker.state == "closed"
+    s.get(stub.url)
+    assert s.breaker.state == "open"
+    with pytest.raises(UpstreamUnavailable):
+        s.get(stub.url)
+    assert len(stub.requests) == 2
+
+    time.sleep(0.25)
+    assert s.breaker.state == "half-open"
+    assert s.get(stub.url).status_code == 200
+    assert s.breaker.state == "closed"
+
+
+def test_half_open_trial_may_retry(stub, waits):
+    s = session(max_retries=2, failure_threshold=1, reset_timeout=0.2)
+    stub.script = [(500, {})] * 3
+    s.get(stub.url)
+    assert s.breaker.state == "open"
+
+    time.sleep(0.25)
+    stub.script = [(500, {}), (200, {})]
+    assert s.get(stub.url).status_code == 200
+    assert s.breaker.state == "closed"
+
+
+def test_abandoned_trial_does_not_keep_breaker_open(stub, waits):
+    s = session(max_retries=0, failure_threshold=1, reset_timeout=0.2)
+    stub.script = [(500, {})]
+    s.get(stub.url)
+    time.sleep(0.25)
+    # Fails before reaching the upstream, so neither success nor failure
+    with pytest.raises(requests.exceptions.InvalidHeader):
+        s.get(stub.url, headers={"X-Bad": "line\nbreak"})
+    assert s.get(stub.url).status_code == 200
+    assert s.breaker.state == "closed"
+
+
+def test_breaker_allows_one_trial_at_a_time():
+    breaker = CircuitBreaker("Stub", failure_threshold=1, reset_timeout=0)
+    assert breaker.before() is False
+    breaker.failure()
+    assert breaker.before() is True
+    with pytest.raises(UpstreamUnavailable):
+        breaker.before()
+    breaker.done(True)
+    assert breaker.before() is True
@@ -0,0 +1,127 @@
+import heapq
+from itertools import compress
+from operator import itemgetter
+import re
+
+# Applications whose destinations are hostnames worth charting
+DEFAULT_APPLICATIONS = ("Miscellaneous web", "Miscellaneous secure web")
+
+# Matches any alphabetic character (same set as str.isalpha)
+_HAS_ALPHA = re.compile(r"[^\W\d_]")
+
+_get_destination = itemgetter("destination")
+_get_application = itemgetter("application")
+_get_sent = itemgetter("sent")
+_get_recv = itemgetter("recv")
+
+
+def aggregate_traffic_legacy(network_traffic):
+    """
+    Original per-entry aggregation loop, kept as the benchmark baseline.
+    :param network_traffic: getNetworkTraffic response
+    :return: List of (destination, total) sorted descending
+    """
+    destinations_and_totals = {}
+    for entry in network_traffic:
+        if entry["application"] == "Miscellaneous web" or entry["application"] == "Miscellaneous secure web":
+            if any(c.isalpha() for c in entry["destination"]):
+                if entry["destination"] not in destinations_and_totals:
+                    destinations_and_totals[entry["destination"]] = entry["sent"] + entry["recv"]
+                else:
+                    destinations_and_totals[entry["destination"]] = destinations_and_totals[entry["destination"]] + entry["sent"] + entry["recv"]
+    return sorted(destinations_and_totals.items(), key=lambda x: x[1], reverse=True)
+
+
+def _reduce(destinations, totals):
+    """
+    Sum totals per unique destination.
+    :param destinations: Sequence of destination strings
+    :param totals: Float array aligned with destinations
+    :return: (list of unique destinations, array of their totals)
+    """
+    # numpy is imported on first use to keep bot startup fast
+    import numpy as np
+    # Factorize with C-level dict/map passes rather than a sort on strings
+    unique = list(dict.fromkeys(destinations))
+    positions = {destination: i for i, destination in enumerate(unique)}
+    codes = np.fromiter(map(positions.__getitem__, destinations), dtype=np.intp, count=len(destinations))
+    return unique, np.bincount(codes, weights=totals, minlength=len(unique))
+
+
+class TrafficAggregator(object):
+    """
+    Columnar traffic aggregation.
+
+    Each add() filters a getNetworkTraffic response by application, pulls
+    the remaining entries into columns and reduces them to per-destination
+    totals with a single bincount, so org-wide results can be merged as
+    each network's response arrives.
+    top() merges the partial results and selects the top K with a heap
+    instead of sorting every destination.
+    """
+
+    # Partial results kept before they are folded together
+    max_chunks = 32
+
+    def __init__(self, applications=DEFAULT_APPLICATIONS):
+        """
+        :param applications: Application names to keep; empty keeps all
+        """
+        self.applications = list(applications or [])
+        self._chunks = []
+
+    def add(self, network_traffic):
+        if not network_traffic:
+            return
+        if self.applications:
+            wanted = frozenset(self.applications)
+            network_traffic = list(compress(network_traffic, map(wanted.__contains__, map(_get_application, network_traffic))))
+            if not network_traffic:
+                return
+        import numpy as np
+        count = len(network_traffic)
+        destinations = list(map(_get_destination, network_traffic))
+        totals = np.fromiter(map(_get_sent, network_traffic), dtype=np.float64, count=count)
+        totals += np.fromiter(map(_get_recv, network_traffic), dtype=np.float64, count=count)
+        unique, sums = _reduce(destinations, totals)
+        # Only unique destinations are scanned for letters, which drops
+        # raw IP addresses
+        keep = np.fromiter((_HAS_ALPHA.search(d) is not None for d in unique),
+                           dtype=bool, count=len(unique))
+        self._chunks.append((list(compress(unique, keep)), sums[keep]))
+        if len(self._chunks) > self.max_chunks:
+            self._compact()
+
+    def _compact(self):
+        if len(self._chunks) > 1:
+            import numpy as np
+            destinations = [d for chunk in self._chunks for d in chunk[0]]
+            totals = np.concatenate([chunk[1] for chunk in self._chunks])
+            self._chunks = [_reduce(destinations, totals)]
+
+    def top(self, k=None):
+        """
+        :param k: Number of destinations to return, or None for all
+        :return: List of (destination, total) sorted descending
+        """
+        self._compact()
+        if not self._chunks:
+            return []
+        destinations, totals = self._chunks[0]
+        pairs = zip(destinations, totals.tolist())
+        if k is None:
+            return sorted(pairs, key=itemgetter(1), reverse=True)
+        return heapq.nlargest(k, pairs, key=itemgetter(1))
+
+
+def aggregate_traffic(network_traffic, applications=DEFAULT_APPLICATIONS, top_k=None):
+    """
+    Aggregate a single getNetworkTraffic response.
+    :param network_traffic: getNetworkTraffic response
+    :param applications: Application names to keep; empty keeps all
+    :param top_k: Number of destinations to return, or None for all
+    :return: List of (destination, total) sorted descending
+    """
+    aggregator = TrafficAggregator(applications)
+    aggregator.add(network_traffic)
+    return aggregator.top(top_k)
@@ -0,0 +1,252 @@
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+from operator import itemgetter
+import re
+from shared import ProcessConnection
+import sys
+import threading
+import time
+
+# Matches any alphabetic character (same set as str.isalpha)
+_HAS_ALPHA = re.compile(r"[^\W\d_]")
+
+
+class TrafficStore(object):
+    """
+    Append-only on-disk store of getNetworkTraffic snapshots.
+
+    Each snapshot covers the window [captured_at - timespan, captured_at]
+    and is stored compactly as one row per (destination, application) with
+    the names interned, so top-talker and day-over-day queries over any
+    range of stored windows are answered locally with a GROUP BY.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: SQLite database file
+        """
+        self._connection = ProcessConnection(path, setup=self._create)
+        self._lock = threading.Lock()
+        self._names = {}
+
+    @property
+    def _db(self):
+        return self._connection.get()
+
+    def _create(self, db):
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS snapshots ("
+                "id INTEGER PRIMARY KEY, network_id TEXT, captured_at REAL, timespan REAL)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS snapshots_network ON snapshots (network_id, captured_at)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS names (id INTEGER PRIMARY KEY, name TEXT UNIQUE)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS traffic ("
+                "snapshot_id INTEGER, destination_id INTEGER, application_id INTEGER, total REAL)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS traffic_snapshot ON traffic (snapshot_id)"
+            )
+            for name_id, name in db.execute("SELECT id, name FROM names"):
+                self._names[name] = name_id
+
+    def _name_id(self, name):
+        # Must be called with self._lock held, inside a transaction. Another
+        # process sharing the file may have interned the name already.
+        name_id = self._names.get(name)
+        if name_id is None:
+            self._db.execute("INSERT OR IGNORE INTO names (name) VALUES (?)", (name,))
+            name_id = self._db.execute("SELECT id FROM names WHERE name = ?", (name,)).fetchone()[0]
+            self._names[name] = name_id
+        return name_id
+
+    def add_snapshot(self, network_id, captured_at, timespan, network_traffic):
+        """
+        Store one getNetworkTraffic response.
+        :param network_id: Network the traffic belongs to
+        :param captured_at: Unix time the snapshot was taken
+        :param timespan: Seconds of traffic the snapshot covers
+        :param network_traffic: getNetworkTraffic response
+        """
+        totals = {}
+        for entry in network_traffic:
+            key = (entry["destination"], entry["application"])
+            totals[key] = totals.get(key, 0) + entry["sent"] + entry["recv"]
+        with self._lock, self._db:
+            snapshot_id = self._db.execute(
+                "INSERT INTO snapshots (network_id, captured_at, timespan) VALUES (?, ?, ?)",
+                (str(network_id), captured_at, timespan)
+            ).lastrowid
+            self._db.executemany(
+                "INSERT INTO traffic VALUES (?, ?, ?, ?)",
+                [(snapshot_id, self._name_id(d), self._name_id(a), total)
+                 for (d, a), total in totals.items()]
+            )
+
+    def coverage(self, network_id):
+        """
+        :return: (earliest window start, latest capture) stored for the
+                network, or None if it has no snapshots
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT MIN(captured_at - timespan), MAX(captured_at) FROM snapshots WHERE network_id = ?",
+                (str(network_id),)
+            ).fetchone()
+        return None if row[0] is None else row
+
+    def totals(self, network_id, start, end, applications=()):
+        """
+        Sum traffic per destination over snapshots captured in (start, end].
+        :param applications: Application names to keep; empty keeps all
+        :return: Dict of destination -> total
+        """
+        query = (
+            "SELECT d.name, SUM(t.total) FROM traffic t "
+            "JOIN snapshots s ON s.id = t.snapshot_id "
+            "JOIN names d ON d.id = t.destination_id "
+            "JOIN names a ON a.id = t.application_id "
+            "WHERE s.network_id = ? AND s.captured_at > ? AND s.captured_at <= ?"
+        )
+        params = [str(network_id), start, end]
+        if applications:
+            query += " AND a.name IN ({})".format(",".join("?" * len(applications)))
+            params += list(applications)
+        query += " GROUP BY t.destination_id"
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        # Keep hostnames only, as the live traffic card does
+        return dict((d, total) for d, total in rows if _HAS_ALPHA.search(d))
+
+    def top(self, network_id, start, end, applications=(), k=10):
+        """
+        :return: Top k (destination, total) over (start, end], descending
+        """
+        return heapq.nlargest(k, self.totals(network_id, start, end, applications).items(), key=itemgetter(1))
+
+    def delta(self, network_id, window, now=None, applications=(), k=10):
+        """
+        Compare the latest window with the one before it, e.g. today vs
+        yesterday.
+        :param window: Window length in seconds
+        :return: Top k (destination, current, previous) by absolute change
+        """
+        now = time.time() if now is None else now
+        current = self.totals(network_id, now - window, now, applications)
+        previous = self.totals(network_id, now - 2 * window, now - window, applications)
+        rows = [(d, current.get(d, 0), previous.get(d, 0)) for d in set(current) | set(previous)]
+        return heapq.nlargest(k, rows, key=lambda row: abs(row[1] - row[2]))
+
+    def prune(self, older_than):
+        """
+        Drop snapshots captured before older_than (Unix time).
+        """
+        with self._lock, self._db:
+            self._db.execute(
+                "DELETE FROM traffic WHERE snapshot_id IN (SELECT id FROM snapshots WHERE captured_at < ?)",
+                (older_than,)
+            )
+            self._db.execute("DELETE FROM snapshots WHERE captured_at < ?", (older_than,))
+
+
+def describe_span(seconds):
+    """
+    Human readable length of stored history, e.g. "2 hours" or "3 days".
+    """
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return "{} minute{}".format(minutes, "" if minutes == 1 else "s")
+    hours = minutes // 60
+    if hours < 48:
+        return "{} hour{}".format(hours, "" if hours == 1 else "s")
+    return "{} days".format(hours // 24)
+
+
+class TrafficSnapshotter(object):
+    """
+    Background thread capturing a snapshot of every selected network each
+    interval seconds, with bounded concurrency.
+
+    Each snapshot covers the interval before it, so a network is only
+    captured once its latest snapshot is at least interval old; after a
+    restart or a leader failover the first round waits for that instead
+    of storing a window that overlaps the previous one, which totals()
+    would count twice.
+    """
+
+    def __init__(self, store, capture, list_networks, interval=7200, max_workers=4, retention=30 * 86400):
+        """
+        :param store: TrafficStore to append to
+        :param capture: Callable taking (network_id, timespan) and returning
+                its getNetworkTraffic response
+        :param list_networks: Callable returning the network ids to capture
+        :param interval: Seconds between snapshots (and each one's timespan)
+        :param max_workers: Networks captured concurrently
+        :param retention: Seconds of snapshots kept
+        """
+        self.store = store
+        self.capture = capture
+        self.list_networks = list_networks
+        self.interval = interval
+        self.max_workers = max_workers
+        self.retention = retention
+        self._stop = threading.Event()
+        self._thread = None
+
+    def snapshot(self, network_id):
+        captured_at = time.time()
+        network_traffic = self.capture(network_id, self.interval)
+        self.store.add_snapshot(network_id, captured_at, self.interval, network_traffic)
+
+    def due_at(self, network_id):
+        """
+        :return: Unix time from which network_id can be captured again
+        """
+        coverage = self.store.coverage(network_id)
+        return 0 if coverage is None else coverage[1] + self.interval
+
+    def run_once(self):
+        """
+        Capture every selected network that is due.
+        :return: Number of networks that failed
+        """
+        now = time.time()
+        due = [n for n in self.list_networks() if self.due_at(n) <= now]
+        failed = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for future in [pool.submit(self.snapshot, n) for n in due]:
+                try:
+                    future.result()
+                except Exception as e:
+                    failed += 1
+                    sys.stderr.write("Traffic snapshot failed: {}\n".format(e))
+        self.store.prune(time.time() - self.retention)
+        return failed
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="traffic-snapshots", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        # Start when the earliest selected network is due
+        try:
+            first = min([self.due_at(n) for n in self.list_networks()] or [0])
+            self._stop.wait(min(max(first - time.time(), 0), self.interval))
+        except Exception as e:
+            sys.stderr.write("Traffic snapshots failed: {}\n".format(e))
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                sys.stderr.write("Traffic snapshots failed: {}\n".format(e))
+            self._stop.wait(self.interval)
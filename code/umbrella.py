@@ -0,0 +1,95 @@
+from concurrent.futures import ThreadPoolExecutor
+import re
+
+_SEPARATORS = re.compile(r"[\s,;]+")
+# A "#" at the start of a line or after a separator comments out the rest
+# of the line; one inside a token (a URL fragment) does not
+_COMMENT = re.compile(r"(?:^|[\s,;])#.*$", re.MULTILINE)
+_DOMAIN = re.compile(r"^(?=.{1,253}$)([a-z0-9_](?:[a-z0-9_-]{0,61}[a-z0-9])?\.)+[a-z0-9-]{2,63}$")
+
+
+def normalize_domains(text):
+    """
+    Parse a pasted or uploaded list of domains (one per line, or comma,
+    semicolon or whitespace separated) into normalized, de-duplicated
+    domains. "#" comments run to the end of their line. Common IOC defanging ("hxxp://", "[.]") is undone and URL
+    schemes, paths and ports are stripped.
+    :param text: Raw text
+    :return: (list of valid domains in input order, list of rejected tokens)
+    """
+    domains = []
+    invalid = []
+    seen = set()
+    for token in _SEPARATORS.split(_COMMENT.sub("", text or "")):
+        token = token.strip().strip("\"'")
+        if not token:
+            continue
+        domain = token.lower().replace("[.]", ".").replace("(.)", ".")
+        domain = re.sub(r"^[a-z]+://", "", domain.replace("hxxp", "http"))
+        domain = domain.split("/", 1)[0].split(":", 1)[0].rstrip(".")
+        if not _DOMAIN.match(domain):
+            invalid.append(token)
+            continue
+        if domain not in seen:
+            seen.add(domain)
+            domains.append(domain)
+    return domains, invalid
+
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def bulk_add_destinations(session, url, domains, chunk_size=500, max_parallel=4, on_progress=None):
+    """
+    Add domains to a destination list in chunked multi-destination POSTs,
+    with at most max_parallel requests in flight.
+    :param session: requests session authenticated for Umbrella
+    :param url: Destination list destinations URL
+    :param domains: Normalized domains
+    :param chunk_size: Destinations per POST
+    :param max_parallel: Concurrent POSTs
+    :param on_progress: Optional callable taking (domains done, total),
+            called after each chunk
+    :return: (list of added domains, list of (domain, reason) failures)
+    """
+    def post(chunk):
+        try:
+            r = session.post(url, json=[{"destination": d} for d in chunk])
+        except Exception as e:
+            return chunk, str(e)
+        if r.status_code == 200:
+            return chunk, None
+        return chunk, "HTTP {}".format(r.status_code)
+
+    added = []
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_parallel) as pool:
+        for chunk, error in pool.map(post, list(chunked(domains, chunk_size))):
+            if error is None:
+                added += chunk
+            else:
+                failed += [(d, error) for d in chunk]
+            if on_progress is not None:
+                on_progress(len(added) + len(failed), len(domains))
+    return added, failed
+
+
+def bulk_summary(list_name, added, failed, invalid, present=0):
+    """
+    Markdown summary of a bulk add.
+    :param present: Number of domains skipped as already on the list
+    """
+    total = len(added) + len(failed) + len(invalid) + present
+    summary = "Added **{}** of {} domains to **{}**.".format(len(added), total, list_name)
+    if present:
+        summary += "  \n{} were already on the list.".format(present)
+    problems = [(d, reason) for d, reason in failed] + [(d, "not a valid domain") for d in invalid]
+    if problems:
+        summary += "  \n{} failed:".format(len(problems))
+        for domain, reason in problems[:20]:
+            summary += "  \n* {} ({})".format(domain, reason)
+        if len(problems) > 20:
+            summary += "  \n* ... and {} more".format(len(problems) - 20)
+    return summary
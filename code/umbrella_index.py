@@ -0,0 +1,196 @@
+from shared import ProcessConnection
+import sys
+import threading
+import time
+
+
+class DestinationIndex(object):
+    """
+    Locally persisted index of Umbrella destination list contents.
+
+    Each list is read from Umbrella with paged GETs and stored in SQLite;
+    membership checks are answered from an in-memory set and successful
+    adds are recorded incrementally, so duplicate checks and list diffs
+    don't re-read the list from the API. Once its sync is older than
+    max_age a list is re-read in a background thread while the existing
+    copy keeps answering, which picks up destinations removed in the
+    Umbrella console; only a list that was never synced makes the caller
+    wait, and concurrent callers share one read. A process reloads its
+    set whenever another process sharing the file synced the list more
+    recently.
+    """
+
+    def __init__(self, path, max_age=3600):
+        """
+        :param path: SQLite database file
+        :param max_age: Seconds before a synced list is read again
+        """
+        self._connection = ProcessConnection(path, setup=self._create)
+        self._lock = threading.Lock()
+        self.max_age = max_age
+        self._sets = {}
+        # List id -> synced_at of the copy in self._sets
+        self._synced = {}
+        self._list_locks = {}
+        self._refreshing = set()
+        # List id -> destinations added while the list is being read, which
+        # the read may have missed
+        self._added_during_sync = {}
+
+    @property
+    def _db(self):
+        return self._connection.get()
+
+    def _create(self, db):
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS lists ("
+                "list_id TEXT PRIMARY KEY, synced_at REAL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS destinations ("
+                "list_id TEXT, destination TEXT, "
+                "PRIMARY KEY (list_id, destination)) WITHOUT ROWID"
+            )
+
+    def ensure_loaded(self, list_id, fetch_pages):
+        """
+        Make sure list_id is indexed. A list that was never synced is read
+        from Umbrella before returning; one whose sync is older than
+        max_age is re-read in the background.
+        :param list_id: Destination list id
+        :param fetch_pages: Callable yielding pages of destination strings
+        """
+        list_id = str(list_id)
+        if self._load(list_id, fetch_pages):
+            return
+        # Never synced: read it once, however many callers are waiting
+        with self._list_lock(list_id):
+            if not self._load(list_id, fetch_pages):
+                self._sync(list_id, fetch_pages)
+
+    def _load(self, list_id, fetch_pages):
+        """
+        Bring the in-memory copy of list_id up to date with the database
+        and start a background re-read if it is older than max_age.
+        :return: False if the list was never synced
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT synced_at FROM lists WHERE list_id = ?", (list_id,)
+            ).fetchone()
+            if row is None:
+                return False
+            if self._synced.get(list_id) != row[0]:
+                self._sets[list_id] = set(
+                    d for (d,) in self._db.execute(
+                        "SELECT destination FROM destinations WHERE list_id = ?", (list_id,))
+                )
+                self._synced[list_id] = row[0]
+            if time.time() - row[0] >= self.max_age and list_id not in self._refreshing:
+                self._refreshing.add(list_id)
+                threading.Thread(
+                    target=self._refresh, args=(list_id, fetch_pages),
+                    name="destination-index-refresh", daemon=True
+                ).start()
+            return True
+
+    def _refresh(self, list_id, fetch_pages):
+        try:
+            with self._list_lock(list_id):
+                # Another process may have re-read it in the meantime
+                row = self._db.execute(
+                    "SELECT synced_at FROM lists WHERE list_id = ?", (list_id,)
+                ).fetchone()
+                if row is None or time.time() - row[0] >= self.max_age:
+                    self._sync(list_id, fetch_pages)
+        except Exception as e:
+            # Keep answering from the old copy; the next use retries
+            sys.stderr.write("Re-reading destination list {} failed: {}\n".format(list_id, e))
+        finally:
+            with self._lock:
+                self._refreshing.discard(list_id)
+
+    def _list_lock(self, list_id):
+        with self._lock:
+            return self._list_locks.setdefault(list_id, threading.Lock())
+
+    def sync(self, list_id, fetch_pages):
+        """
+        Replace the indexed contents of list_id with a full read from
+        Umbrella.
+        """
+        list_id = str(list_id)
+        with self._list_lock(list_id):
+            self._sync(list_id, fetch_pages)
+
+    # Must be called with the list's lock held
+    def _sync(self, list_id, fetch_pages):
+        with self._lock:
+            self._added_during_sync[list_id] = set()
+        try:
+            destinations = set()
+            for page in fetch_pages():
+                destinations.update(d.lower() for d in page)
+            synced_at = time.time()
+            with self._lock, self._db:
+                destinations.update(self._added_during_sync[list_id])
+                self._db.execute("DELETE FROM destinations WHERE list_id = ?", (list_id,))
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO destinations VALUES (?, ?)",
+                    ((list_id, d) for d in destinations)
+                )
+                self._db.execute(
+                    "INSERT OR REPLACE INTO lists VALUES (?, ?)", (list_id, synced_at)
+                )
+                self._sets[list_id] = destinations
+                self._synced[list_id] = synced_at
+        finally:
+            with self._lock:
+                self._added_during_sync.pop(list_id, None)
+
+    def contains(self, list_id, destination):
+        with self._lock:
+            return destination.lower() in self._sets.get(str(list_id), ())
+
+    def missing(self, list_id, destinations):
+        """
+        :return: The destinations not yet on list_id, in input order
+        """
+        with self._lock:
+            present = self._sets.get(str(list_id), ())
+            return [d for d in destinations if d.lower() not in present]
+
+    def extra(self, list_id, destinations):
+        """
+        :return: How many indexed entries of list_id are not in destinations
+        """
+        wanted = set(d.lower() for d in destinations)
+        with self._lock:
+            return len(self._sets.get(str(list_id), set()) - wanted)
+
+    def add(self, list_id, destinations):
+        """
+        Record destinations successfully added to list_id.
+        """
+        list_id = str(list_id)
+        destinations = [d.lower() for d in destinations]
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO destinations VALUES (?, ?)",
+                ((list_id, d) for d in destinations)
+            )
+            if list_id in self._sets:
+                self._sets[list_id].update(destinations)
+            if list_id in self._added_during_sync:
+                self._added_during_sync[list_id].update(destinations)
+
+    def invalidate(self):
+        """
+        Forget every list so each is re-read from Umbrella on next use.
+        """
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM destinations")
+            self._db.execute("DELETE FROM lists")
+            self._sets.clear()
+            self._synced.clear()
@@ -0,0 +1,81 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import sys
+import threading
+
+
+class WorkerPool(object):
+    """
+    Bounded pool that runs webhook handlers off the request thread.
+
+    At most max_workers jobs run at once and at most max_queue more wait
+    for a worker; submissions past that are rejected rather than queued so
+    a slow upstream can't build an unbounded backlog.
+    """
+
+    def __init__(self, mode="thread", max_workers=4, max_queue=100,
+                 initializer=None):
+        """
+        :param mode: "thread" or "process"
+        :param max_workers: Number of concurrent workers
+        :param max_queue: Jobs allowed to wait for a free worker
+        :param initializer: Optional callable run once in each worker
+        """
+        if mode == "thread":
+            self._executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="card-worker",
+                initializer=initializer
+            )
+        elif mode == "process":
+            self._executor = ProcessPoolExecutor(
+                max_workers=max_workers, initializer=initializer
+            )
+        else:
+            raise ValueError("Unknown worker mode: {}".format(mode))
+        self.mode = mode
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._closed = False
+
+    @property
+    def pending(self):
+        """Number of jobs queued or running."""
+        return self._pending
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue fn(*args, **kwargs) on the pool.
+        :return: A Future, or None if the pool is full or shutting down
+        """
+        if self._closed or not self._slots.acquire(blocking=False):
+            return None
+        with self._lock:
+            self._pending += 1
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except RuntimeError:
+            # Executor was shut down between the check and the submit
+            self._release()
+            return None
+        future.add_done_callback(self._done)
+        return future
+
+    def shutdown(self, wait=True):
+        """
+        Stop accepting work and, if wait is True, drain queued and running
+        jobs before returning.
+        """
+        self._closed = True
+        self._executor.shutdown(wait=wait)
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    def _done(self, future):
+        self._release()
+        if not future.cancelled() and future.exception() is not None:
+            sys.stderr.write("Worker job failed: {!r}\n".format(future.exception()))